@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+""" Reproducible benchmarks of bmloader on synthetic recordings
+
+Each case runs in a fresh process so the reported peak RSS is its own.
+    python benchmarks/run.py                      # run every case
+    python benchmarks/run.py --save base.json     # keep the results
+    python benchmarks/run.py --compare base.json  # exit 1 on regressions
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import bmloader
+from bmloader.lib import synthetic
+
+
+def _fresh_cache(config, name):
+    """ Point the disk cache at an empty directory and drop the memory tier """
+    cache_dir = os.path.join(config['workdir'], 'cache-{}'.format(name))
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    bmloader.set_cache_dir(cache_dir)
+    bmloader.clear_memory_cache()
+
+
+def _data_bytes(f):
+    return int(f.NumDataPoints) * int(f.NumChannels) * 2
+
+
+# cases: name -> (setup(config) -> state, prepare(state) or None, run(state) -> bytes processed)
+# prepare runs before every repetition and is not timed
+def _setup_config(config):
+    return config
+
+
+def _setup_path(key):
+    return lambda config: config[key]
+
+
+def _run_nsx_open(path):
+    f = bmloader.openNSx(path)
+    f.close()
+    return os.path.getsize(path)
+
+
+def _setup_nsx_opened(config):
+    return bmloader.openNSx(config['nsx'])
+
+
+def _setup_nsx_mapped(config):
+    f = bmloader.openNSx()
+    f.load(config['nsx'])
+    return f
+
+
+def _prepare_nsx_header(f):
+    f.BasicHeader = None
+    f.ExtendedHeader = None
+
+
+def _run_nsx_header(f):
+    f._parse_basic_header()
+    f._parse_extended_header()
+    return f.BasicHeader['Bytes_in_Headers']
+
+
+def _run_nsx_channel(f):
+    f.get_data_from_channels([1])
+    return _data_bytes(f) // int(f.NumChannels)
+
+
+def _run_nsx_all_channels(f):
+    f.get_data_from_channels(list(f._channel_index.keys()), dtype=np.float32)
+    return _data_bytes(f)
+
+
+def _setup_nsx_windows(config):
+    f = bmloader.openNSx(config['nsx'])
+    rng = np.random.default_rng(0)
+    duration = f.TotalDataPoints / float(f.SamplingFreq)
+    starts = rng.uniform(0, max(duration - 1.0, 0), size=100)
+    return f, starts, list(f._channel_index.keys())[:4]
+
+
+def _run_nsx_windows(state):
+    f, starts, ch_ids = state
+    nbytes = 0
+    for t in starts.tolist():
+        # scaled reads copy every sample, raw windows would be zero-copy views
+        _, yp = f.get_data_from_channels(ch_ids, t, t + 1.0, dtype=np.float32)
+        nbytes += yp.size * f._data[0].itemsize
+    return nbytes
+
+
+def _setup_nsx_decimate(config):
+    f = bmloader.openNSx(config['nsx'])
+    return f, list(f._channel_index.keys())[:8]
+
+
+def _run_nsx_decimate(state):
+    f, ch_ids = state
+    f.get_data_from_channels(ch_ids, down_sampling=30)
+    return _data_bytes(f) // int(f.NumChannels) * len(ch_ids)
+
+
+def _run_nsx_resample(state):
+    f, ch_ids = state
+    for ch_id in ch_ids:
+        f.get_data_from_channel(ch_id, down_sampling=30.0)
+    return _data_bytes(f) // int(f.NumChannels) * len(ch_ids)
+
+
+def _prepare_nev_index(config):
+    _fresh_cache(config, 'nev_index')
+
+
+def _run_nev_index(config):
+    n = bmloader.openNEV(config['nev'])
+    n._parse_events_map()
+    n._set_spikes()
+    n.close()
+    return os.path.getsize(config['nev'])
+
+
+def _run_spike_table(n):
+    n._parse_spikes(os.path.basename(n._path))
+    return os.path.getsize(n._path)
+
+
+def _setup_cache_miss(config):
+    return bmloader.openNEV(config['nev']), config
+
+
+def _prepare_cache_miss(state):
+    _fresh_cache(state[1], 'cache')
+
+
+def _run_cache_miss(state):
+    return _run_spike_table(state[0])
+
+
+def _setup_cached(config):
+    _fresh_cache(config, 'cache')
+    n = bmloader.openNEV(config['nev'])
+    _run_spike_table(n)
+    return n
+
+
+def _prepare_cache_disk_hit(n):
+    bmloader.clear_memory_cache()
+
+
+CASES = dict(nsx_open=(_setup_path('nsx'), None, _run_nsx_open),
+             nsx_header=(_setup_nsx_mapped, _prepare_nsx_header, _run_nsx_header),
+             nsx_channel=(_setup_nsx_opened, None, _run_nsx_channel),
+             nsx_all_channels=(_setup_nsx_opened, None, _run_nsx_all_channels),
+             nsx_windows=(_setup_nsx_windows, None, _run_nsx_windows),
+             nsx_decimate=(_setup_nsx_decimate, None, _run_nsx_decimate),
+             nsx_resample=(_setup_nsx_decimate, None, _run_nsx_resample),
+             nev_index=(_setup_config, _prepare_nev_index, _run_nev_index),
+             cache_miss=(_setup_cache_miss, _prepare_cache_miss, _run_cache_miss),
+             cache_disk_hit=(_setup_cached, _prepare_cache_disk_hit, _run_spike_table),
+             cache_memory_hit=(_setup_cached, None, _run_spike_table))
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024.0 ** 2 if sys.platform == 'darwin' else peak / 1024.0
+
+
+def run_case(name, config):
+    """ Run one case (in the current process), returns its timings """
+    setup, prepare, run = CASES[name]
+    state = setup(config)
+    times = []
+    nbytes = 0
+    for _ in range(config['repeat']):
+        if prepare is not None:
+            prepare(state)
+        start = time.perf_counter()
+        nbytes = run(state)
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return dict(case=name, best=best, median=float(np.median(times)), bytes=int(nbytes),
+                mb_per_sec=nbytes / 1024.0 ** 2 / best if best > 0 else float('inf'),
+                peak_rss_mb=_peak_rss_mb())
+
+
+def generate(config):
+    """ Write the synthetic recordings used by every case """
+    config['nsx'] = os.path.join(config['workdir'], 'bench.ns6')
+    config['nev'] = os.path.join(config['workdir'], 'bench.nev')
+    synthetic.write_nsx(config['nsx'], channels=config['channels'], duration=config['duration'],
+                        segments=config['segments'], seed=config['seed'])
+    synthetic.write_nev(config['nev'], channels=config['channels'], duration=config['duration'],
+                        spike_rate=config['spike_rate'], seed=config['seed'])
+    return config
+
+
+def compare(results, baseline, tolerance):
+    """ Cases whose best time regressed beyond tolerance against a saved run """
+    previous = {r['case']: r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        if r['case'] in previous and r['best'] > previous[r['case']]['best'] * (1 + tolerance):
+            regressions.append((r['case'], previous[r['case']]['best'], r['best']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('cases', nargs='*', default=list(CASES.keys()), help='cases to run (default: all)')
+    parser.add_argument('--channels', type=int, default=96)
+    parser.add_argument('--duration', type=float, default=60.0, help='recording duration (sec)')
+    parser.add_argument('--segments', type=int, default=1)
+    parser.add_argument('--spike-rate', type=float, default=20.0, help='firing rate per electrode (Hz)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help='directory of the synthetic files (default: temporary)')
+    parser.add_argument('--save', default=None, help='write the results as JSON')
+    parser.add_argument('--compare', default=None, help='JSON of a previous run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown for --compare')
+    args = parser.parse_args()
+
+    for name in args.cases:
+        if name not in CASES.keys():
+            parser.error('unknown case: {}'.format(name))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bmloader-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    config = generate(dict(workdir=workdir, channels=args.channels, duration=args.duration,
+                           segments=args.segments, spike_rate=args.spike_rate,
+                           repeat=args.repeat, seed=args.seed))
+    print('nsx: {:.1f} MB, nev: {:.1f} MB'.format(os.path.getsize(config['nsx']) / 1024.0 ** 2,
+                                                  os.path.getsize(config['nev']) / 1024.0 ** 2))
+    print('{:<18}{:>12}{:>12}{:>12}{:>14}'.format('case', 'best (ms)', 'median (ms)', 'MB/s', 'peak RSS (MB)'))
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    try:
+        for name in args.cases:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                r = pool.submit(run_case, name, config).result()
+            results.append(r)
+            print('{:<18}{:>12.2f}{:>12.2f}{:>12.1f}{:>14.1f}'.format(
+                r['case'], r['best'] * 1e3, r['median'] * 1e3, r['mb_per_sec'], r['peak_rss_mb']))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = dict(config={k: v for k, v in config.items() if k not in ('workdir', 'nsx', 'nev')},
+                  version=bmloader.__version__, results=results)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, before, after in regressions:
+            print('REGRESSION {}: {:.2f} ms -> {:.2f} ms'.format(name, before * 1e3, after * 1e3))
+        if len(regressions):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
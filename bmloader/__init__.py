@@ -1,7 +1,14 @@
 from .lib.nsx import *
 from .lib.nev import *
 from .lib.utils import *
+from .lib.session import Session
+from .lib.catalog import scan_file, scan_directory, load_catalog
+from .lib.metrics import Metrics, collect_metrics, enable_metrics, disable_metrics, get_metrics
+from .lib import synthetic
 
 __version__ = '0.0.1'
 
-__all__ = ['openNEV', 'openNSx', 'timeit', 'disk_cache']
\ No newline at end of file
+__all__ = ['openNEV', 'openNSx', 'Session', 'scan_file', 'scan_directory', 'load_catalog', 'TimeAxis', 'read_data_parallel', 'timeit', 'disk_cache',
+           'set_cache_dir', 'get_cache_dir', 'set_cache_size', 'clear_cache', 'file_fingerprint',
+           'set_memory_cache_size', 'clear_memory_cache', 'synthetic',
+           'Metrics', 'collect_metrics', 'enable_metrics', 'disable_metrics', 'get_metrics']
\ No newline at end of file
@@ -1,7 +1,6 @@
-from pandas import DataFrame
 import struct
+import re
 import numpy as np
-import pandas as pd
 
 
 # Global variables
@@ -10,149 +9,275 @@ TIME_UNIT = 's'
 PACKETID_SIZE = 8
 PACKETID_DTYPE = '8s'
 
+_NUMPY_TYPES = {'B': 'u1', 'b': 'i1', 'H': '<u2', 'h': '<i2',
+                'I': '<u4', 'i': '<i4', 'f': '<f4', '?': '?'}
+
+
+class HeaderLayout(object):
+    """ Binary layout of a header section, compiled once into a little-endian
+    struct.Struct (single record) and a NumPy structured dtype (bulk decoding)
+    Parameters:
+        rows: list of [Field, Type, Bytes]
+    """
+    def __init__(self, rows):
+        self.rows = [list(row) for row in rows]
+        self.Field = [row[0] for row in self.rows]
+        self.Type = [row[1] for row in self.rows]
+        self.Bytes = np.asarray([row[2] for row in self.rows], dtype=np.int64)
+        self.struct = struct.Struct('<' + ''.join(self.Type))
+        self.size = self.struct.size
+        if self.size != self.Bytes.sum():
+            raise Exception(self.rows)
+
+        self._counts = []
+        dtype = []
+        for field, dtype_str in zip(self.Field, self.Type):
+            count, code = re.match(r'(\d*)(\D)$', dtype_str).groups()
+            count = int(count) if count else 1
+            if code == 's':
+                self._counts.append(-1)
+                dtype.append((field, 'S{}'.format(count)))
+            else:
+                self._counts.append(count)
+                dtype.append((field, _NUMPY_TYPES[code], (count,)) if count > 1 else
+                             (field, _NUMPY_TYPES[code]))
+        self.dtype = np.dtype(dtype)
+
+    def unpack(self, buffer, offset=0):
+        """ Decode a single record into a dict (strings are null-terminated latin-1) """
+        values = self.struct.unpack_from(buffer, offset)
+        output = dict()
+        loc = 0
+        for field, count in zip(self.Field, self._counts):
+            if count < 0:
+                output[field] = values[loc].decode('latin-1').split('\x00', 1)[0]
+                loc += 1
+            elif count == 1:
+                output[field] = values[loc]
+                loc += 1
+            else:
+                output[field] = tuple(values[loc:loc + count])
+                loc += count
+        return output
+
+    def frombuffer(self, buffer, count=-1, offset=0):
+        """ Bulk decode of consecutive records into a structured array """
+        return np.frombuffer(buffer, dtype=self.dtype, count=count, offset=offset)
+
+    def to_records(self, array):
+        """ Convert a structured array decoded with this layout into a list of dicts """
+        columns = []
+        for field, count in zip(self.Field, self._counts):
+            if count < 0:
+                columns.append([v.decode('latin-1').split('\x00', 1)[0] for v in array[field]])
+            elif count == 1:
+                columns.append(array[field].tolist())
+            else:
+                columns.append([tuple(v) for v in array[field].tolist()])
+        return [dict(zip(self.Field, values)) for values in zip(*columns)]
+
+    def to_frame(self):
+        """ pandas.DataFrame view of the layout table (imports pandas on demand) """
+        from pandas import DataFrame
+        return DataFrame(self.rows, columns=HEADER_COLUMNS)
+
+    def __repr__(self):
+        return repr(self.to_frame())
+
+
 # NSx File Format
 # Section 1 - Basic Header
 # NEURALCD
 NSX_BASIC = \
-    DataFrame([['File_Type_ID',                      '8s',   8   ],
-               ['File_Spec',                         '2B',   2   ],
-               ['Bytes_in_Headers',                  'I',    4   ],
-               ['Label',                             '16s',  16  ],
-               ['Comment',                           '256s', 256 ],
-               ['Period',                            'I',    4   ],
-               ['Time_Resolution_of_Time_Stamps',    'I',    4   ],
-               ['Time_Origin',                       '8H',   16  ],
-               ['Channel_Count',                     'I',    4   ]],
-              columns = HEADER_COLUMNS)
+    HeaderLayout([['File_Type_ID',                      '8s',   8   ],
+                  ['File_Spec',                         '2B',   2   ],
+                  ['Bytes_in_Headers',                  'I',    4   ],
+                  ['Label',                             '16s',  16  ],
+                  ['Comment',                           '256s', 256 ],
+                  ['Period',                            'I',    4   ],
+                  ['Time_Resolution_of_Time_Stamps',    'I',    4   ],
+                  ['Time_Origin',                       '8H',   16  ],
+                  ['Channel_Count',                     'I',    4   ]])
 
 # Section 2 - Extended Header
 NSX_EXTENDED = \
-    DataFrame([['Type',                              '2s',   2   ],
-               ['Electrode_ID',                      'H',    2   ],
-               ['Electrode_Label',                   '16s',  16  ],
-               ['Physical_Connector',                'B',    1   ],
-               ['Connector_Pin',                     'B',    1   ],
-               ['Min_Digital_Value',                 'h',    2   ],
-               ['Max_Digital_Value',                 'h',    2   ],
-               ['Min_Analog_Value',                  'h',    2   ],
-               ['Max_Analog_Value',                  'h',    2   ],
-               ['Units',                             '16s',  16  ],
-               ['High_Freq_Corner',                  'I',    4   ],
-               ['High_Freq_Order',                   'I',    4   ],
-               ['High_Filter_Type',                  'H',    2   ],
-               ['Low_Freq_Corner',                   'I',    4   ],
-               ['Low_Freq_Order',                    'I',    4   ],
-               ['Low_Filter_Type',                   'H',    2   ]],
-              columns = HEADER_COLUMNS)
+    HeaderLayout([['Type',                              '2s',   2   ],
+                  ['Electrode_ID',                      'H',    2   ],
+                  ['Electrode_Label',                   '16s',  16  ],
+                  ['Physical_Connector',                'B',    1   ],
+                  ['Connector_Pin',                     'B',    1   ],
+                  ['Min_Digital_Value',                 'h',    2   ],
+                  ['Max_Digital_Value',                 'h',    2   ],
+                  ['Min_Analog_Value',                  'h',    2   ],
+                  ['Max_Analog_Value',                  'h',    2   ],
+                  ['Units',                             '16s',  16  ],
+                  ['High_Freq_Corner',                  'I',    4   ],
+                  ['High_Freq_Order',                   'I',    4   ],
+                  ['High_Filter_Type',                  'H',    2   ],
+                  ['Low_Freq_Corner',                   'I',    4   ],
+                  ['Low_Freq_Order',                    'I',    4   ],
+                  ['Low_Filter_Type',                   'H',    2   ]])
 
 # Section 3 - Data Packets
 NSX_DATA = \
-    DataFrame([['Header',                            'B',    1   ],
-               ['Timestamp',                         'I',    4   ],
-               ['Number_of_Data_Points',             'I',    4   ],
-               ['Data_Point',                        'h',    2   ]],
-              columns = HEADER_COLUMNS)
+    HeaderLayout([['Header',                            'B',    1   ],
+                  ['Timestamp',                         'I',    4   ],
+                  ['Number_of_Data_Points',             'I',    4   ],
+                  ['Data_Point',                        'h',    2   ]])
 
 # NEV File Format
 # Section 1 - Basic Header
 NEURALEV = \
-    DataFrame([['File_Type_ID',                      '8s',   8   ],
-               ['File_Spec',                         '2B',   2   ],
-               ['Add_Flags',                         'H',    2   ],
-               ['Bytes_in_Headers',                  'I',    4   ],
-               ['Bytes_in_DataPackets',              'I',    4   ],
-               ['TimeStamp_Resolution',              'I',    4   ],
-               ['Sample_Time_Resolution',            'I',    4   ],
-               ['Time_Origin',                       '8H',   16  ],
-               ['Creating_Application',              '32s',  32  ],
-               ['Comment',                           '256s', 256 ],
-               ['Num_Extended_Headers',              'I',    4   ]],
-              columns = HEADER_COLUMNS)
+    HeaderLayout([['File_Type_ID',                      '8s',   8   ],
+                  ['File_Spec',                         '2B',   2   ],
+                  ['Add_Flags',                         'H',    2   ],
+                  ['Bytes_in_Headers',                  'I',    4   ],
+                  ['Bytes_in_DataPackets',              'I',    4   ],
+                  ['TimeStamp_Resolution',              'I',    4   ],
+                  ['Sample_Time_Resolution',            'I',    4   ],
+                  ['Time_Origin',                       '8H',   16  ],
+                  ['Creating_Application',              '32s',  32  ],
+                  ['Comment',                           '256s', 256 ],
+                  ['Num_Extended_Headers',              'I',    4   ]])
 
 # Section 2 - Extended Header
 ARRAYNME = \
-    DataFrame([['Array_Name',                        '24s',  24  ]],
-              columns = HEADER_COLUMNS)
+    HeaderLayout([['Array_Name',                        '24s',  24  ]])
 
 ECOMMENT = \
-    DataFrame([['Extra_Comment',                     '24s',  24  ]],
-              columns = HEADER_COLUMNS)
+    HeaderLayout([['Extra_Comment',                     '24s',  24  ]])
 
 CCOMMENT = \
-    DataFrame([['Cont_Comment',                      '24s',  24  ]],
-              columns = HEADER_COLUMNS)
+    HeaderLayout([['Cont_Comment',                      '24s',  24  ]])
 
 MAPFILE = \
-    DataFrame([['Map_File',                          '24s',  14  ]],
-              columns = HEADER_COLUMNS)
+    HeaderLayout([['Map_File',                          '24s',  24  ]])
 
 NEUEVWAV = \
-    DataFrame([['Electrode_ID',                      'H',    2   ],
-               ['Physical_Connector',                'B',    1   ],
-               ['Connector_Pin',                     'B',    1   ],
-               ['Digitization_Factor',               'H',    2   ],
-               ['Energy_Threshold',                  'H',    2   ],
-               ['High_Threshold',                    'h',    2   ],
-               ['Low_Threshold',                     'h',    2   ],
-               ['Num_Sorted_Units',                  'B',    1   ],
-               ['Bytes_Per_Waveform',                'B',    1   ],
-               ['Spike_Width_Samples',               'H',    2   ],
-               ['Empty_Bytes',                       '8s',   8   ]],
-               columns = HEADER_COLUMNS)
+    HeaderLayout([['Electrode_ID',                      'H',    2   ],
+                  ['Physical_Connector',                'B',    1   ],
+                  ['Connector_Pin',                     'B',    1   ],
+                  ['Digitization_Factor',               'H',    2   ],
+                  ['Energy_Threshold',                  'H',    2   ],
+                  ['High_Threshold',                    'h',    2   ],
+                  ['Low_Threshold',                     'h',    2   ],
+                  ['Num_Sorted_Units',                  'B',    1   ],
+                  ['Bytes_Per_Waveform',                'B',    1   ],
+                  ['Spike_Width_Samples',               'H',    2   ],
+                  ['Empty_Bytes',                       '8s',   8   ]])
 
 NEUEVLBL = \
-    DataFrame([['Electrode_ID',                      'H',    2   ],
-               ['Label',                             '16s',  16  ],
-               ['Empty_Bytes',                       '6s',   6   ]],
-               columns = HEADER_COLUMNS)
+    HeaderLayout([['Electrode_ID',                      'H',    2   ],
+                  ['Label',                             '16s',  16  ],
+                  ['Empty_Bytes',                       '6s',   6   ]])
 
 NEUEVFLT = \
-    DataFrame([['Electrode_ID',                      'H',    2   ],
-               ['High_Freq_Corner',                  'I',    4   ],
-               ['High_Freq_Order',                   'I',    4   ],
-               ['High_Freq_Type',                    'H',    2   ],
-               ['Low_Freq_Corner',                   'I',    4   ],
-               ['Low_Freq_Order',                    'I',    4   ],
-               ['Low_Freq_Type',                     'H',    2   ],
-               ['Empty_Bytes',                       '2s',   2   ]],
-               columns = HEADER_COLUMNS)
+    HeaderLayout([['Electrode_ID',                      'H',    2   ],
+                  ['High_Freq_Corner',                  'I',    4   ],
+                  ['High_Freq_Order',                   'I',    4   ],
+                  ['High_Freq_Type',                    'H',    2   ],
+                  ['Low_Freq_Corner',                   'I',    4   ],
+                  ['Low_Freq_Order',                    'I',    4   ],
+                  ['Low_Freq_Type',                     'H',    2   ],
+                  ['Empty_Bytes',                       '2s',   2   ]])
 
 DIGLABEL = \
-    DataFrame([['Label',                             '16s',  16  ],
-               ['Mode',                              '?',    1   ],
-               ['Empty_Bytes',                       '7s',   7   ]],
-               columns = HEADER_COLUMNS)
+    HeaderLayout([['Label',                             '16s',  16  ],
+                  ['Mode',                              '?',    1   ],
+                  ['Empty_Bytes',                       '7s',   7   ]])
 
 NSASEXEV = \
-    DataFrame([['Frequency',                         'H',    2   ],
-               ['DigitalInputConfig',                'B',    1   ],
-               ['AnalogCh1Config',                   'B',    1   ],
-               ['AnalogCh1DetectVal',                'h',    2   ],
-               ['AnalogCh2Config',                   'B',    1   ],
-               ['AnalogCh2DetectVal',                'h',    2   ],
-               ['AnalogCh3Config',                   'B',    1   ],
-               ['AnalogCh3DetectVal',                'h',    2   ],
-               ['AnalogCh4Config',                   'B',    1   ],
-               ['AnalogCh4DetectVal',                'h',    2   ],
-               ['AnalogCh5Config',                   'B',    1   ],
-               ['AnalogCh5DetectVal',                'h',    2   ],
-               ['EmptyBytes',                        '8s',   8   ]],
-               columns = HEADER_COLUMNS)
+    HeaderLayout([['Frequency',                         'H',    2   ],
+                  ['DigitalInputConfig',                'B',    1   ],
+                  ['AnalogCh1Config',                   'B',    1   ],
+                  ['AnalogCh1DetectVal',                'h',    2   ],
+                  ['AnalogCh2Config',                   'B',    1   ],
+                  ['AnalogCh2DetectVal',                'h',    2   ],
+                  ['AnalogCh3Config',                   'B',    1   ],
+                  ['AnalogCh3DetectVal',                'h',    2   ],
+                  ['AnalogCh4Config',                   'B',    1   ],
+                  ['AnalogCh4DetectVal',                'h',    2   ],
+                  ['AnalogCh5Config',                   'B',    1   ],
+                  ['AnalogCh5DetectVal',                'h',    2   ],
+                  ['EmptyBytes',                        '6s',   6   ]])
 
 VIDEOSYN = \
-    DataFrame([['VideoSourceID',                     'H',    2   ],
-               ['VideoSource',                       '16s',  16  ],
-               ['FrameRate',                         'f',    4   ],
-               ['EmptyBytes',                        '2s',   2   ]],
-               columns = HEADER_COLUMNS)
+    HeaderLayout([['VideoSourceID',                     'H',    2   ],
+                  ['VideoSource',                       '16s',  16  ],
+                  ['FrameRate',                         'f',    4   ],
+                  ['EmptyBytes',                        '2s',   2   ]])
 
 TRACKOBJ = \
-    DataFrame([['TrackableType',                     'H',    2   ],
-               ['TrackableID',                       'H',    2   ],
-               ['PointCount',                        'H',    2   ],
-               ['VideoSource',                       '16s',  16  ],
-               ['EmptyBytes',                        '2s',   2   ]],
-               columns = HEADER_COLUMNS)
+    HeaderLayout([['TrackableType',                     'H',    2   ],
+                  ['TrackableID',                       'H',    2   ],
+                  ['PointCount',                        'H',    2   ],
+                  ['VideoSource',                       '16s',  16  ],
+                  ['EmptyBytes',                        '2s',   2   ]])
+
+NEV_EXTENDED = {'ARRAYNME': ARRAYNME, 'ECOMMENT': ECOMMENT, 'CCOMMENT': CCOMMENT,
+                'MAPFILE': MAPFILE, 'NEUEVWAV': NEUEVWAV, 'NEUEVLBL': NEUEVLBL,
+                'NEUEVFLT': NEUEVFLT, 'DIGLABEL': DIGLABEL, 'NSASEXEV': NSASEXEV,
+                'VIDEOSYN': VIDEOSYN, 'TRACKOBJ': TRACKOBJ}
+NEV_EXTENDED_SIZE = PACKETID_SIZE + 24
+
+# Section 3 - Data Packets (packet IDs 1-2048 are spike events of the electrode)
+NEV_PACKET_HEADER = [('Timestamp', '<u4'), ('Packet_ID', '<u2')]
+NEV_PACKET_HEADER_SIZE = 6
+NEV_EVENT_TYPES = {0:     'Digital_Events',
+                   65535: 'Comment_Events',
+                   65534: 'Video_Sync_Event',
+                   65533: 'Tracking_Event',
+                   65532: 'Button_Trigger_Event',
+                   65531: 'Log_Event',
+                   65530: 'Configuration_Event'}
+
+# Payload layouts following the packet header, the optional tail field takes the remaining bytes
+NEV_DIGITAL_EVENT = \
+    HeaderLayout([['Packet_Insertion_Reason',           'B',    1   ],
+                  ['Reserved',                          'B',    1   ],
+                  ['Digital_Input',                     'H',    2   ]])
+
+NEV_COMMENT_EVENT = \
+    HeaderLayout([['Char_Set',                          'B',    1   ],
+                  ['Flag',                              'B',    1   ],
+                  ['Data',                              'I',    4   ]])
+
+NEV_VIDEO_SYNC_EVENT = \
+    HeaderLayout([['File_Number',                       'H',    2   ],
+                  ['Frame_Number',                      'I',    4   ],
+                  ['Elapsed_Time',                      'I',    4   ],
+                  ['Source_ID',                         'I',    4   ]])
+
+NEV_TRACKING_EVENT = \
+    HeaderLayout([['Parent_ID',                         'H',    2   ],
+                  ['Node_ID',                           'H',    2   ],
+                  ['Node_Count',                        'H',    2   ],
+                  ['Point_Count',                       'H',    2   ]])
+
+NEV_BUTTON_TRIGGER_EVENT = \
+    HeaderLayout([['Trigger_Type',                      'H',    2   ]])
+
+NEV_LOG_EVENT = \
+    HeaderLayout([['Mode',                              'H',    2   ],
+                  ['Application_Name',                  '32s',  32  ]])
+
+NEV_CONFIGURATION_EVENT = \
+    HeaderLayout([['Change_Type',                       'H',    2   ]])
+
+NEV_EVENT_LAYOUTS = {'Digital_Events':          (NEV_DIGITAL_EVENT,          None),
+                     'Comment_Events':          (NEV_COMMENT_EVENT,          ('Comment', 'S')),
+                     'Video_Sync_Event':        (NEV_VIDEO_SYNC_EVENT,       None),
+                     'Tracking_Event':          (NEV_TRACKING_EVENT,         ('Points', '<u2')),
+                     'Button_Trigger_Event':    (NEV_BUTTON_TRIGGER_EVENT,   None),
+                     'Log_Event':               (NEV_LOG_EVENT,              ('Comment', 'S')),
+                     'Configuration_Event':     (NEV_CONFIGURATION_EVENT,    ('Changed', 'S'))}
+
+# Number of coordinates per point of each TRACKOBJ TrackableType
+TRACKABLE_DIMENSIONS = {1: 2,   # 2D rigid body markers
+                        2: 2,   # 2D rigid body blob
+                        3: 3,   # 3D rigid body markers
+                        4: 2,   # 2D boundary
+                        5: 1}   # 1D size marker
 
 
 # Helper functions
@@ -239,18 +364,118 @@ def parse_comment_event(output, data_packet):
     return output
 
 
+class TimeAxis(np.lib.mixins.NDArrayOperatorsMixin):
+    """ Lazy evenly spaced time axis (unit: sec), materialized only on demand
+    contiguous slices stay lazy, any other index, arithmetic, comparison or NumPy
+    function works on the materialized float64 array like the ndarray it stands in for
+    Parameters:
+        start: sample index of the first element
+        num: number of samples
+        fs: sampling frequency
+    """
+    def __init__(self, start, num, fs):
+        self.start = int(start)
+        self.num = int(num)
+        self.fs = float(fs)
+
+    @property
+    def shape(self):
+        return (self.num,)
+
+    @property
+    def ndim(self):
+        return 1
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float64)
+
+    def __len__(self):
+        return self.num
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self.num)
+            if step == 1:
+                return TimeAxis(self.start + start, max(stop - start, 0), self.fs)
+            return np.asarray(self)[idx]
+        if not isinstance(idx, (int, np.integer)):
+            # boolean masks, integer arrays, Ellipsis, ...
+            return np.asarray(self)[idx]
+        if idx < 0:
+            idx += self.num
+        if not 0 <= idx < self.num:
+            raise IndexError(idx)
+        return (self.start + idx) / self.fs
+
+    def __array__(self, dtype=None, copy=None):
+        xp = np.arange(self.start, self.start + self.num) / self.fs
+        return xp if dtype is None else xp.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(np.asarray(x) if isinstance(x, TimeAxis) else x for x in inputs)
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __repr__(self):
+        return 'TimeAxis(start={}, num={}, fs={})'.format(self.start, self.num, self.fs)
+
+
 class BaseLoader():
     def __init__(self):
         self.ExtendedHeader = None
+        self._channel_index = None
+        self._channel_labels = None
+        self._channel_map = None
+        self._fingerprint = None
 
     def check_channel_map(self, arg):
         if self.ExtendedHeader is None:
             raise Exception
 
-        channel_data = [{'ID': info['Electrode_ID'], 'Label': info[arg]} for idx, info in self.ExtendedHeader.items()]
-        self.ChannelMap = pd.DataFrame(channel_data, columns=['ID', 'Label'])
-        pd.set_option('display.max_rows', len(self.ChannelMap) + 1)
-        self.NumChannels = len(self.ChannelMap)
+        self._channel_index = dict()
+        self._channel_labels = []
+        for idx, info in enumerate(self.ExtendedHeader.values()):
+            self._channel_index[info['Electrode_ID']] = idx
+            self._channel_labels.append(info.get(arg))
+        self._channel_map = None
+        self.NumChannels = len(self._channel_index)
+
+    @property
+    def ChannelMap(self):
+        """ pandas.DataFrame of channel IDs and labels (pandas is imported on first access) """
+        if self._channel_index is None:
+            return None
+        if self._channel_map is None:
+            import pandas as pd
+            self._channel_map = pd.DataFrame({'ID': list(self._channel_index.keys()),
+                                              'Label': self._channel_labels},
+                                             columns=['ID', 'Label'])
+            pd.set_option('display.max_rows', len(self._channel_map) + 1)
+        return self._channel_map
+
+    def _remap(self):
+        """ Map the file again at its current size (live recordings), returns True if it grew
+        load() also renews the cache fingerprint, views handed out earlier keep the previous map
+        """
+        import os
+        if os.path.getsize(self._path) <= self._filesize:
+            return False
+        previous = self._fileobj
+        self.load(self._path)
+        self._close_map(previous)
+        return True
+
+    @staticmethod
+    def _close_map(fileobj):
+        """ Close an mmap unless views handed out to the caller still reference it,
+        it is then released once they are garbage collected
+        """
+        if fileobj is None:
+            return
+        try:
+            fileobj.close()
+        except BufferError:
+            pass
 
     @staticmethod
     def remove_code(data, code='\x00'):
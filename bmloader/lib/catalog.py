@@ -0,0 +1,183 @@
+""" Header-only catalog of an archive of Blackrock recordings in SQLite
+
+Only the basic and extended headers (and the data packet headers of NSx files) are
+read, so a file is indexed without decoding its samples, spikes or events.
+"""
+import os
+import sqlite3
+import numpy as np
+from . import NSX_BASIC, NEURALEV
+from .nsx import openNSx
+from .nev import openNEV
+
+CATALOG_EXTENSIONS = ['.nev', '.ns1', '.ns2', '.ns3', '.ns4', '.ns5', '.ns6']
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, session TEXT, stream TEXT, size INTEGER, mtime REAL,
+    file_spec TEXT, label TEXT, comment TEXT, time_origin TEXT, time_resolution INTEGER,
+    sampling_rate REAL, channels INTEGER, segments INTEGER, packets INTEGER,
+    data_points INTEGER, start REAL, duration REAL, error TEXT);
+CREATE TABLE IF NOT EXISTS channels (
+    path TEXT, electrode_id INTEGER, label TEXT, units TEXT, PRIMARY KEY (path, electrode_id));
+CREATE INDEX IF NOT EXISTS files_session ON files (session);
+"""
+
+NSX_TIME_ORIGIN_OFFSET = NSX_BASIC.dtype.fields['Time_Origin'][1]
+NEV_TIME_ORIGIN_OFFSET = NEURALEV.dtype.fields['Time_Origin'][1]
+
+FILE_COLUMNS = ['path', 'session', 'stream', 'size', 'mtime', 'file_spec', 'label', 'comment',
+                'time_origin', 'time_resolution', 'sampling_rate', 'channels', 'segments',
+                'packets', 'data_points', 'start', 'duration', 'error']
+
+
+def _iso_time_origin(buffer, offset):
+    """ Time_Origin (Windows SYSTEMTIME) as an ISO 8601 string, sortable in SQL """
+    year, month, _, day, hour, minute, second, msec = \
+        np.frombuffer(buffer, dtype='<u2', count=8, offset=offset).tolist()
+    return '{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}.{:03d}'.format(year, month, day, hour, minute, second, msec)
+
+
+def _sql_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _scan_nsx(path, record):
+    nsx = openNSx()
+    try:
+        nsx.load(path, fingerprint=False)
+        nsx._parse_basic_header()
+        nsx._parse_extended_header()
+        # walks the data packet headers only, samples are never touched
+        nsx.parse_data_header()
+        fs = float(nsx.SamplingFreq)
+        record.update(file_spec=nsx.BasicHeader['File_Spec'], label=nsx.BasicHeader['Label'],
+                      comment=nsx.BasicHeader['Comment'],
+                      time_origin=_iso_time_origin(nsx._fileobj, NSX_TIME_ORIGIN_OFFSET),
+                      time_resolution=nsx.BasicHeader['Time_Resolution_of_Time_Stamps'],
+                      sampling_rate=fs, channels=nsx.NumChannels, segments=len(nsx.Segments),
+                      packets=len(nsx.Segments), data_points=nsx.NumDataPoints,
+                      start=int(nsx.Segments['Start'][0]) / fs,
+                      duration=(nsx.TotalDataPoints - int(nsx.Segments['Start'][0])) / fs)
+        channels = [(path, ch_id, header['Electrode_Label'], header['Units'])
+                    for ch_id, header in nsx.ExtendedHeader.items()]
+    finally:
+        nsx.close()
+    return record, channels
+
+
+def _scan_nev(path, record):
+    nev = openNEV()
+    nev._path = path
+    try:
+        nev.load(path, fingerprint=False)
+        nev._parse_basic_header()
+        nev._parse_extended_header()
+        skip_size = nev.BasicHeader['Bytes_in_Headers']
+        dpacket_size = nev.BasicHeader['Bytes_in_DataPackets']
+        fs = float(nev.BasicHeader['TimeStamp_Resolution'])
+        num_dpacket = (nev._filesize - skip_size) // dpacket_size
+        record.update(file_spec=nev.BasicHeader['File_Spec'],
+                      label=nev.BasicHeader['Creating_Application'], comment=nev.BasicHeader['Comment'],
+                      time_origin=_iso_time_origin(nev._fileobj, NEV_TIME_ORIGIN_OFFSET),
+                      time_resolution=nev.BasicHeader['TimeStamp_Resolution'],
+                      sampling_rate=float(nev.BasicHeader['Sample_Time_Resolution']),
+                      channels=nev.NumChannels, packets=int(num_dpacket))
+        if num_dpacket:
+            # packets are written in timestamp order, only the first and last are read
+            first = np.frombuffer(nev._fileobj, dtype='<u4', count=1, offset=skip_size)[0]
+            last = np.frombuffer(nev._fileobj, dtype='<u4', count=1,
+                                 offset=skip_size + (num_dpacket - 1) * dpacket_size)[0]
+            record.update(start=int(first) / fs, duration=(int(last) - int(first)) / fs)
+        channels = [(path, ch_id, header.get('Label', ''), nev.Unit_Waveform)
+                    for ch_id, header in nev.ExtendedHeader.items()]
+    finally:
+        nev.close()
+    return record, channels
+
+
+def scan_file(path):
+    """ Catalog entry of a single file from its headers
+    Parameters:
+        path: path of a .nev or .ns1-.ns6 file
+    Returns:
+        record: dict of the FILE_COLUMNS (error holds the message of an unreadable file)
+        channels: list of (path, electrode_id, label, units)
+    """
+    stat = os.stat(path)
+    session, ext = os.path.splitext(path)
+    record = dict.fromkeys(FILE_COLUMNS)
+    record.update(path=path, session=session, stream=ext.lower().lstrip('.'),
+                  size=stat.st_size, mtime=stat.st_mtime)
+    try:
+        if record['stream'] == 'nev':
+            return _scan_nev(path, record)
+        return _scan_nsx(path, record)
+    except Exception as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+        return record, []
+
+
+def find_recordings(root, extensions=None):
+    """ Paths of the recordings under a directory tree """
+    extensions = CATALOG_EXTENSIONS if extensions is None else [e.lower() for e in extensions]
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in extensions:
+                paths.append(os.path.join(dirpath, filename))
+    return sorted(paths)
+
+
+def scan_directory(root, database, workers=None, extensions=None, rescan=False):
+    """ Scan a directory tree into a SQLite catalog with a process pool
+    files already cataloged with the same size and mtime are skipped unless rescan is set
+    Parameters:
+        root: top directory of the archive
+        database: path of the SQLite file (created if missing)
+        workers: number of processes (default: os.cpu_count())
+        extensions: file extensions to include (default: CATALOG_EXTENSIONS)
+        rescan: scan every file again
+    Returns:
+        number of files scanned
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    conn = sqlite3.connect(database)
+    try:
+        conn.executescript(CATALOG_SCHEMA)
+        known = dict()
+        if not rescan:
+            known = {path: (size, mtime) for path, size, mtime in
+                     conn.execute('SELECT path, size, mtime FROM files WHERE error IS NULL')}
+        paths = []
+        for path in find_recordings(root, extensions):
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_size, stat.st_mtime):
+                paths.append(path)
+        if not len(paths):
+            return 0
+
+        workers = int(workers or os.cpu_count() or 1)
+        insert = 'INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(
+            ', '.join(FILE_COLUMNS), ', '.join(['?'] * len(FILE_COLUMNS)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, min(64, len(paths) // (workers * 4)))
+            for record, channels in pool.map(scan_file, paths, chunksize=chunksize):
+                conn.execute('DELETE FROM channels WHERE path = ?', (record['path'],))
+                conn.execute(insert, [_sql_value(record[c]) for c in FILE_COLUMNS])
+                conn.executemany('INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?)', channels)
+        conn.commit()
+        return len(paths)
+    finally:
+        conn.close()
+
+
+def load_catalog(database, table='files'):
+    """ A catalog table as a pandas.DataFrame (imports pandas on demand) """
+    from pandas import read_sql_query
+    conn = sqlite3.connect(database)
+    try:
+        return read_sql_query('SELECT * FROM {}'.format(table), conn)
+    finally:
+        conn.close()
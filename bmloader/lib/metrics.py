@@ -0,0 +1,155 @@
+""" Opt-in instrumentation of the loaders
+
+Stages (wall time and call count) and counters (bytes, packets, cache events) are
+only recorded while a Metrics collector is active, otherwise every hook returns
+after a single global lookup.
+
+    with collect_metrics() as m:
+        nsx = openNSx(path)
+        nsx.get_data_from_channel(1)
+    m.to_dict()
+"""
+import time
+import functools
+import threading
+from contextlib import contextmanager
+
+_active = None
+
+
+class Metrics(object):
+    """ Collector of per-stage timings and counters
+    Parameters:
+        callback: optional function called with to_dict() when collection stops
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = dict()
+        self.counters = dict()
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            if name not in self.stages.keys():
+                self.stages[name] = dict(calls=0, seconds=0.0)
+            self.stages[name]['calls'] += 1
+            self.stages[name]['seconds'] += seconds
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+
+    def to_dict(self):
+        """ Returns:
+            dict(stages={name: dict(calls, seconds)}, counters={name: value})
+        """
+        with self._lock:
+            return dict(stages={k: dict(v) for k, v in self.stages.items()},
+                        counters=dict(self.counters))
+
+    def __repr__(self):
+        return 'Metrics({})'.format(self.to_dict())
+
+
+class _Stage(object):
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def enable_metrics(callback=None):
+    """ Start collecting into a new Metrics, which is returned """
+    global _active
+    _active = Metrics(callback)
+    return _active
+
+
+def disable_metrics():
+    """ Stop collecting, the callback of the active Metrics receives its dict
+    Returns:
+        the Metrics that was active (or None)
+    """
+    global _active
+    metrics, _active = _active, None
+    if metrics is not None and metrics.callback is not None:
+        metrics.callback(metrics.to_dict())
+    return metrics
+
+
+def get_metrics():
+    return _active
+
+
+@contextmanager
+def collect_metrics(callback=None):
+    """ Collect metrics within the block, the previously active collector is restored on exit """
+    global _active
+    previous = _active
+    metrics = enable_metrics(callback)
+    try:
+        yield metrics
+    finally:
+        disable_metrics()
+        _active = previous
+
+
+def stage(name):
+    """ Context manager timing a stage, a shared no-op when metrics are disabled """
+    metrics = _active
+    if metrics is None:
+        return _null_stage
+    return _Stage(metrics, name)
+
+
+def count(name, value=1):
+    """ Increase a counter (bytes read, packets decoded, cache events) """
+    metrics = _active
+    if metrics is not None:
+        metrics.add(name, value)
+
+
+def profiled(name):
+    """ Decorator timing every call of the function as the given stage """
+    def wrapper(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            metrics = _active
+            if metrics is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.record(name, time.perf_counter() - start)
+
+        return wrapped
+
+    return wrapper
@@ -1,27 +1,102 @@
 from . import *
-from .utils import disk_cache, hashlib
+from .utils import disk_cache, mapped_fingerprint, hashlib
+from .metrics import profiled, count
 import os
 
 
+def _group_packet_ids(packet_ids, offset=0):
+    """ Group packet indices (shifted by offset) by packet ID, in file order within each group """
+    order = np.argsort(packet_ids, kind='stable')
+    unique_ids, first = np.unique(packet_ids[order], return_index=True)
+
+    ev_index = dict()
+    for packet_id, index in zip(unique_ids.tolist(), np.split(order, first[1:])):
+        # 1 <= packet_id <= 2048 are spike events and keep the electrode ID as key
+        ev_index[NEV_EVENT_TYPES.get(packet_id, packet_id)] = index + offset
+    return ev_index
+
+
+def _sort_spike_packets(packet_ids, tstamps):
+    """ Indices of the spike packets sorted by electrode, then by timestamp """
+    index = np.flatnonzero((packet_ids >= 1) & (packet_ids <= 2048))
+    return index[np.lexsort((tstamps[index], packet_ids[index]))]
+
+
+def _decode_nev_shard(path, skip_size, dpacket_size, start, stop):
+    """ Process pool worker: decode the data packets [start, stop) with a private mmap """
+    import mmap
+    with open(path, 'rb') as f:
+        fileobj = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    dtype = NEV_PACKET_HEADER + [('Unit_Classification', 'u1'),
+                                 ('Payload', 'V{}'.format(dpacket_size - NEV_PACKET_HEADER_SIZE - 1))]
+    packets = np.frombuffer(fileobj, dtype=dtype, count=stop - start, offset=skip_size + start * dpacket_size)
+    packet_ids = packets['Packet_ID'].copy()
+    tstamps = packets['Timestamp'].copy()
+    units = packets['Unit_Classification'].copy()
+    del packets
+    fileobj.close()
+
+    index = _sort_spike_packets(packet_ids, tstamps)
+    spikes = dict(Timestamp=tstamps[index],
+                  Electrode=packet_ids[index],
+                  Unit_Classification=units[index],
+                  Packet_Index=index + start)
+    return _group_packet_ids(packet_ids, offset=start), spikes
+
+
+def _merge_nev_shards(results):
+    """ Concatenate shard results in file order into one events map and spike table """
+    ev_index = dict()
+    for shard_index, _ in results:
+        for key, index in shard_index.items():
+            if key not in ev_index.keys():
+                ev_index[key] = []
+            ev_index[key].append(index)
+    ev_index = {key: np.concatenate(index) for key, index in ev_index.items()}
+
+    spikes = {key: np.concatenate([shard_spikes[key] for _, shard_spikes in results])
+              for key in results[0][1].keys()}
+    # shards are sorted internally, a stable sort by electrode keeps timestamps
+    # ordered as long as the file itself is time ordered
+    order = np.argsort(spikes['Electrode'], kind='stable')
+    electrodes = spikes['Electrode'][order]
+    tstamps = spikes['Timestamp'][order]
+    if ((np.diff(electrodes) == 0) & (np.diff(tstamps.astype(np.int64)) < 0)).any():
+        order = np.lexsort((spikes['Timestamp'], spikes['Electrode']))
+    return ev_index, {key: column[order] for key, column in spikes.items()}
+
+
 class openNEV(BaseLoader):
     _cache_dir = os.path.join(os.curdir, '_bmcache_')
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, workers=None):
+        """
+        Parameters:
+            path: NEV file path
+            workers: number of processes used to parse the data packets (default: serial)
+        """
         super(openNEV, self).__init__()
         self._path = path
+        self._workers = workers
         self._path_cache = None
         self._fileobj = None
+        self._packets = None
         self._events_map = None
-        self._events = dict()
+        self._events_tail = dict()
+        self._spikes = None
+        self._spike_slices = None
+        self._spike_tail = dict()
+        self._spike_rows = dict()
+        self._waveforms = None
         self._filesize = None
 
         # Headers
         self.BasicHeader = None
         self.ExtendedHeader = None
         self.OtherHeaders = None
+        self.ExtendedRecords = None
 
         # Attributes
-        self.ChannelMap = None
         self.NumChannels = None
         self.Unit_Waveform = 'nV'
 
@@ -31,36 +106,40 @@ class openNEV(BaseLoader):
             self._parse_extended_header()
             self._parse_events_map()
 
-    def load(self, path):
+    @profiled('nev.open')
+    def load(self, path, fingerprint=True):
+        """ Map the file read-only
+        Parameters:
+            path: file path
+            fingerprint: hash the first bytes of the map to key disk_cache entries
+                         (skipped by header-only readers such as the catalog)
+        """
         import mmap
         with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
             self._fileobj = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         self._filesize = len(self._fileobj)
+        self._fingerprint = mapped_fingerprint(self._fileobj, stat) if fingerprint else None
         self._path_hash = int(hashlib.sha1(self._path.encode('utf-8')).hexdigest(), 16) % (10 ** 8)
 
     @property
     def avail_events(self):
-        return sorted([k for k in self._events_map.keys() if isinstance(k, int)])
+        keys = set(self._events_map.keys()) | set(self._events_tail.keys())
+        return sorted([k for k in keys if isinstance(k, int)])
 
+    @profiled('nev.basic_header')
     def _parse_basic_header(self):
         if self._fileobj is None:
             raise Exception
 
         if self.BasicHeader is None:
-            self.BasicHeader = dict()
-            bh_size = NEURALEV.Bytes.sum()
-            bh_data = self._fileobj[0:bh_size]
-            loc = 0
-            for i, row in NEURALEV.iterrows():
-                c, loc = self.decoding(bh_data, row.Type, loc, row.Bytes)
-                if row.Field is 'File_Spec':
-                    c = "{}.{}".format(*c)
-                elif row.Field is 'Time_Origin':
-                    c = convert_winsystime_struct(c)
-                self.BasicHeader[row.Field] = c
+            self.BasicHeader = NEURALEV.unpack(self._fileobj)
+            self.BasicHeader['File_Spec'] = "{}.{}".format(*self.BasicHeader['File_Spec'])
+            self.BasicHeader['Time_Origin'] = convert_winsystime_struct(self.BasicHeader['Time_Origin'])
         else:
             pass
 
+    @profiled('nev.extended_header')
     def _parse_extended_header(self):
         if self._fileobj is None:
             raise Exception
@@ -69,189 +148,403 @@ class openNEV(BaseLoader):
             self._parse_basic_header()
 
         if self.ExtendedHeader is None:
-            eh_start = NEURALEV.Bytes.sum()
-            eh_end = self.BasicHeader['Bytes_in_Headers']
-
-            eh_data = self._fileobj[eh_start:eh_end]
-
             self.ExtendedHeader = dict()
             self.OtherHeaders = dict()
-
-            loc = 0
-            for hdr in range(self.BasicHeader['Num_Extended_Headers']):
-                packet_id = struct.unpack(PACKETID_DTYPE,
-                                          eh_data[loc:loc + PACKETID_SIZE])[0].decode('utf-8')
-                loc += PACKETID_SIZE
-
-                section = globals()[packet_id]
-
-                if packet_id in ['NEUEVWAV', 'NEUEVLBL', 'NEUEVFLT']:
-                    header = dict()
-                    for i, row in section.iterrows():
-                        if row.Field != 'Empty_Bytes':
-                            header[row.Field], loc = self.decoding(eh_data, row.Type, loc, row.Bytes)
-                        else:
-                            loc += row.Bytes
-
-                    eid = header['Electrode_ID']
-                    if eid not in self.ExtendedHeader.keys():
-                        self.ExtendedHeader[eid] = dict()
-
-                    for key, value in header.items():
-                        if key not in self.ExtendedHeader[eid].keys():
-                            self.ExtendedHeader[eid][key] = value
-                else:
-                    if packet_id not in self.OtherHeaders.keys():
-                        self.OtherHeaders[packet_id] = dict()
-                    for i, row in section.iterrows():
-                        if row.Field != 'Empty_Bytes':
-                            c = struct.unpack(row.Type, eh_data[loc:loc + row.Bytes])
-                            if len(c) == 1:
-                                if 's' in row.Type:
-                                    c = remove_code(c)
-                                else:
-                                    c = c[0]
-                            self.OtherHeaders[packet_id][row.Field] = c
-                        loc += row.Bytes
+            self.ExtendedRecords = dict()
+
+            # all extended headers share a fixed size, decode them in bulk per packet ID
+            records = np.frombuffer(self._fileobj,
+                                    dtype=[('Packet_ID', 'S{}'.format(PACKETID_SIZE)),
+                                           ('Payload', 'V{}'.format(NEV_EXTENDED_SIZE - PACKETID_SIZE))],
+                                    count=self.BasicHeader['Num_Extended_Headers'],
+                                    offset=NEURALEV.size)
+            packet_ids = [pid.decode('latin-1').split('\x00', 1)[0] for pid in records['Packet_ID']]
+            for packet_id in dict.fromkeys(packet_ids):
+                if packet_id not in NEV_EXTENDED.keys():
+                    continue
+                section = NEV_EXTENDED[packet_id]
+                payload = records['Payload'][np.asarray(packet_ids) == packet_id].tobytes()
+                for header in section.to_records(section.frombuffer(payload)):
+                    header = {k: v for k, v in header.items() if k not in ['Empty_Bytes', 'EmptyBytes']}
+                    if packet_id not in self.ExtendedRecords.keys():
+                        self.ExtendedRecords[packet_id] = []
+                    self.ExtendedRecords[packet_id].append(header)
+                    if packet_id in ['NEUEVWAV', 'NEUEVLBL', 'NEUEVFLT']:
+                        eid = header['Electrode_ID']
+                        if eid not in self.ExtendedHeader.keys():
+                            self.ExtendedHeader[eid] = dict()
+
+                        for key, value in header.items():
+                            if key not in self.ExtendedHeader[eid].keys():
+                                self.ExtendedHeader[eid][key] = value
+                    else:
+                        if packet_id not in self.OtherHeaders.keys():
+                            self.OtherHeaders[packet_id] = dict()
+                        self.OtherHeaders[packet_id].update(header)
+            del records
         self.check_channel_map('Label')
 
-    @disk_cache(f'_event_byte_loc', _cache_dir, method=True)
-    def _parse_event_byte_loc(self, path):
+    def _parse_packet_view(self):
+        """ Zero-copy structured view (Timestamp, Packet_ID, Payload) of the data packets over the mmap """
         skip_size = self.BasicHeader['Bytes_in_Headers']
         dpacket_size = self.BasicHeader['Bytes_in_DataPackets']
         num_dpacket = int((self._filesize - skip_size) / dpacket_size)
+        dtype = NEV_PACKET_HEADER + [('Payload', 'V{}'.format(dpacket_size - NEV_PACKET_HEADER_SIZE))]
+        self._packets = np.frombuffer(self._fileobj, dtype=dtype, count=num_dpacket, offset=skip_size)
+
+    @disk_cache(f'_event_index', _cache_dir, method=True)
+    @profiled('nev.events_map')
+    def _parse_event_index(self, path):
+        """ Group data packets by packet ID into sorted arrays of packet indices """
+        count('nev.packets', len(self._packets))
+        return _group_packet_ids(self._packets['Packet_ID'])
+
+    @disk_cache(f'_sharded_index', _cache_dir, method=True)
+    @profiled('nev.sharded')
+    def _parse_sharded(self, path):
+        """ Events map and spike table decoded by a process pool
+        the packet region is split into contiguous shards of whole packets, each worker
+        maps the file on its own and decodes its shard, results are merged by concatenation
+        """
+        from concurrent.futures import ProcessPoolExecutor
 
-        ev_b_loc = dict()
-        for i in range(num_dpacket):
-            loc = skip_size + i * dpacket_size
-            packet_id = struct.unpack('<H', self._fileobj[loc + 4:loc + 6])[0]
-            if packet_id == 0:
-                # digital_input
-                packet_id = 'Digital_Events'
-            elif 1 <= packet_id <= 2048:
-                # spike_event
-                pass
-            elif packet_id == 65535:
-                # command_event
-                packet_id = 'Comment_Events'
-
-            # TODO: below cases are not yet integrated
-            elif packet_id == 65534:  # Video sync event
-                packet_id = 'Video_Sync_Event'
-            elif packet_id == 65533:  # Tracking event
-                packet_id = 'Tracking_Event'
-            elif packet_id == 65532:  # Button trigger event
-                packet_id = 'Button_Trigger_Event'
-            elif packet_id == 65531:  # Log event
-                packet_id = 'Log_Event'
-            elif packet_id == 65530:  # Configuration event
-                packet_id = 'Congiguration_Event'
-            else:
-                pass
-
-            if packet_id not in ev_b_loc.keys():
-                ev_b_loc[packet_id] = []
-            ev_b_loc[packet_id].append(loc)
-        return ev_b_loc
+        skip_size = self.BasicHeader['Bytes_in_Headers']
+        dpacket_size = self.BasicHeader['Bytes_in_DataPackets']
+        bounds = np.linspace(0, len(self._packets), int(self._workers) + 1).astype(np.int64).tolist()
+        shards = [(self._path, skip_size, dpacket_size, start, stop)
+                  for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        if not len(shards):
+            return _group_packet_ids(self._packets['Packet_ID']), self._parse_spikes(os.path.basename(self._path))
+        with ProcessPoolExecutor(max_workers=int(self._workers)) as pool:
+            results = list(pool.map(_decode_nev_shard, *zip(*shards)))
+        return _merge_nev_shards(results)
 
     def _parse_events_map(self):
         if self.ExtendedHeader is None:
             self._parse_extended_header()
 
+        if self._packets is None:
+            self._parse_packet_view()
+
         if self._events_map is None:
-            self._events_map = self._parse_event_byte_loc(os.path.basename(self._path))
-
-    @staticmethod
-    def _parse_digital_input(output, data_packet):
-        if not len(output.keys()):
-            output = dict(Timestamp=[],
-                          Packet_Insertion_Reason=[],
-                          Reserved=[],
-                          Digital_Input=[])
-        output['Timestamp'].append(struct.unpack('<I', data_packet[:4])[0])
-        output['Packet_Insertion_Reason'].append(struct.unpack('B', data_packet[6:7])[0])
-        output['Reserved'].append(struct.unpack('B', data_packet[7:8])[0])
-        output['Digital_Input'].append(struct.unpack('<H', data_packet[8:10])[0])
-        return output
+            if self._workers is not None and self._workers > 1:
+                self._events_map, spikes = self._parse_sharded(os.path.basename(self._path))
+                self._set_spikes(spikes)
+            else:
+                self._events_map = self._parse_event_index(os.path.basename(self._path))
 
-    @staticmethod
-    def _parse_comment_event(output, data_packet):
-        if not len(output.keys()):
-            output = dict(Timestamp=[],
-                          Char_Set=[],
-                          Flag=[],
-                          Data=[],
-                          Comment=[])
-        output['Timestamp'].append(struct.unpack('<I', data_packet[:4])[0])
-        output['Char_Set'].append(struct.unpack('B', data_packet[6:7])[0])
-        output['Flag'].append(struct.unpack('B', data_packet[7:8])[0])
-        output['Data'].append(struct.unpack('<I', data_packet[8:12])[0])
-        output['Comment'].append(bytes.decode(data_packet[12:], 'latin-1').split('\x00', 1)[0])
+    def refresh(self):
+        """ Pick up packets appended to a file that is still being recorded
+        the file is mapped again and only the new packets are indexed; their groups are
+        appended per packet ID and their spike rows per electrode, and are merged into
+        the events map and spike table lazily, when those are queried
+        Returns:
+            range of the new packet indices
+        """
+        self._parse_events_map()
+        n_old = len(self._packets)
+        if not self._remap():
+            return range(n_old, n_old)
+        self._parse_packet_view()
+        if self._waveforms is not None:
+            self._parse_waveform_view()
+        new = self._packets[n_old:]
+        if not len(new):
+            return range(n_old, n_old)
+
+        packet_ids = new['Packet_ID']
+        count('nev.packets', len(new))
+        for key, index in _group_packet_ids(packet_ids, offset=n_old).items():
+            self._events_tail.setdefault(key, []).append(index)
+        # a spike table parsed later covers the whole remapped file, only an existing one gets a tail
+        if self._spikes is not None:
+            index = _sort_spike_packets(packet_ids, new['Timestamp'])
+            units = self._packet_field_view(NEV_PACKET_HEADER_SIZE, np.uint8)[n_old:]
+            spikes = dict(Timestamp=new['Timestamp'][index],
+                          Electrode=packet_ids[index],
+                          Unit_Classification=units[index],
+                          Packet_Index=index + n_old)
+            electrodes, first = np.unique(spikes['Electrode'], return_index=True)
+            bounds = first.tolist() + [len(index)]
+            for eid, start, stop in zip(electrodes.tolist(), bounds[:-1], bounds[1:]):
+                self._spike_tail.setdefault(eid, []).append({k: v[start:stop] for k, v in spikes.items()})
+        return range(n_old, len(self._packets))
+
+    def _get_new_events(self, packets):
+        """ Spikes and decoded events of the packet index range returned by refresh, in file order """
+        packet_ids = self._packets['Packet_ID'][packets.start:packets.stop]
+        spike = np.flatnonzero((packet_ids >= 1) & (packet_ids <= 2048))
+        index = spike + packets.start
+        output = dict(Spikes=dict(Timestamp=self._packets['Timestamp'][index],
+                                  Electrode=packet_ids[spike],
+                                  Unit_Classification=self._packet_field_view(NEV_PACKET_HEADER_SIZE, np.uint8)[index],
+                                  Packet_Index=index))
+        for key, index in _group_packet_ids(packet_ids, offset=packets.start).items():
+            if key not in NEV_EVENT_LAYOUTS.keys():
+                continue
+            layout, tail = NEV_EVENT_LAYOUTS[key]
+            events = self._decode_event_packets(index, layout, tail)
+            if key == 'Tracking_Event':
+                events = self._set_tracking_info(events)
+            elif key == 'Video_Sync_Event':
+                events = self._set_video_source_info(events)
+            output[key] = events
         return output
 
-    def _parse_spike_event(self, output, data_packet):
-        if not len(output.keys()):
-            output = dict(Timestamp=[],
-                          Unit_Classification=[],
-                          Reserved=[],
-                          Waveform=[])
-
-        eid = struct.unpack('<H', data_packet[4:6])[0]
-        output['Timestamp'].append(struct.unpack('<I', data_packet[:4])[0])
-        # the classifier can be defined as string here
-        output['Unit_Classification'].append(struct.unpack('B', data_packet[6:7])[0])
-        output['Reserved'].append(struct.unpack('B', data_packet[7:8])[0])
-
-        bytes_size = self.ExtendedHeader[eid]['Bytes_Per_Waveform']
-        digit_factor = self.ExtendedHeader[eid]['Digitization_Factor']
-        spike_width = self.ExtendedHeader[eid]['Spike_Width_Samples']
-
-        if bytes_size <= 1:
-            data_type = np.int8
-        elif bytes_size == 2:
-            data_type = np.int16
-        else:
+    def follow(self, poll_interval=0.001, timeout=None):
+        """ Yield the packets appended to a file that is still being recorded
+        Parameters:
+            poll_interval: delay between checks of the file size (unit: sec)
+            timeout: stop after this long without new packets (unit: sec, default: never)
+        Yields:
+            dict(Spikes=dict(Timestamp, Electrode, Unit_Classification, Packet_Index)) with the
+            new spikes in file order, plus the decoded columns of each new event type
+            (e.g. Digital_Events, Comment_Events)
+        """
+        import time
+        idle = time.monotonic()
+        while True:
+            packets = self.refresh()
+            if len(packets):
+                idle = time.monotonic()
+                yield self._get_new_events(packets)
+            elif timeout is not None and time.monotonic() - idle > timeout:
+                return
+            else:
+                time.sleep(poll_interval)
+
+    def _packet_field_view(self, offset, dtype, n_values=None):
+        """ Zero-copy strided view of a field at a fixed byte offset inside every data packet
+        shaped (n_packets,) or (n_packets, n_values)
+        """
+        skip_size = self.BasicHeader['Bytes_in_Headers']
+        dpacket_size = self.BasicHeader['Bytes_in_DataPackets']
+        dtype = np.dtype(dtype)
+        num_dpacket = len(self._packets)
+        shape = (num_dpacket,) if n_values is None else (num_dpacket, n_values)
+        if not num_dpacket or n_values == 0:
+            return np.zeros(shape, dtype=dtype)
+        count = ((num_dpacket - 1) * dpacket_size) // dtype.itemsize + (n_values or 1)
+        flat = np.frombuffer(self._fileobj, dtype=dtype, count=count, offset=skip_size + offset)
+        strides = (dpacket_size,) if n_values is None else (dpacket_size, dtype.itemsize)
+        return np.lib.stride_tricks.as_strided(flat, shape=shape, strides=strides, writeable=False)
+
+    def _parse_waveform_view(self):
+        """ Zero-copy strided int16 view (n_packets, n_samples) of the waveform payloads over the mmap
+        the waveform sits at a fixed offset inside each fixed-size packet, so rows are
+        one packet apart; non-spike packets are simply never indexed
+        """
+        dpacket_size = self.BasicHeader['Bytes_in_DataPackets']
+        wf_start = NEV_PACKET_HEADER_SIZE + 2
+        self._waveforms = self._packet_field_view(wf_start, '<i2', (dpacket_size - wf_start) // 2)
+
+    @disk_cache('_spike_table', _cache_dir, method=True)
+    @profiled('nev.spikes')
+    def _parse_spikes(self, path):
+        """ Decode every spike packet in a single pass into columnar arrays
+        rows are sorted by electrode and by timestamp within each electrode, so each
+        electrode is a sorted slice that can be queried by binary search; waveforms
+        are not copied but served from the mmap through Packet_Index
+        Returns:
+            dict of Timestamp (uint32), Electrode (uint16), Unit_Classification (uint8)
+            and Packet_Index (int64)
+        """
+        packet_ids = self._packets['Packet_ID']
+        index = _sort_spike_packets(packet_ids, self._packets['Timestamp'])
+        return dict(Timestamp=self._packets['Timestamp'][index],
+                    Electrode=packet_ids[index],
+                    Unit_Classification=self._packet_field_view(NEV_PACKET_HEADER_SIZE, np.uint8)[index],
+                    Packet_Index=index)
+
+    def _set_spikes(self, spikes=None):
+        if spikes is None:
+            spikes = self._parse_spikes(os.path.basename(self._path))
+        self._spikes = spikes
+        self._spike_tail = dict()
+        self._spike_rows = dict()
+        electrodes, first, counts = np.unique(self._spikes['Electrode'], return_index=True, return_counts=True)
+        self._spike_slices = {eid: slice(start, start + n) for eid, start, n in
+                              zip(electrodes.tolist(), first.tolist(), counts.tolist())}
+
+    def _get_spike_rows(self, ch_id):
+        """ Spike columns of one electrode, sorted by timestamp
+        views of the electrode slice of the spike table, or its merged copy once refresh
+        appended rows to the electrode
+        """
+        if self._spikes is None:
+            self._set_spikes()
+        if self._waveforms is None:
+            self._parse_waveform_view()
+        if ch_id in self._spike_tail.keys():
+            rows = self._spike_rows.get(ch_id)
+            if rows is None:
+                spikes = self._spike_slices.get(ch_id, slice(0, 0))
+                rows = {key: column[spikes] for key, column in self._spikes.items()}
+            chunks = [rows] + self._spike_tail.pop(ch_id)
+            rows = {key: np.concatenate([chunk[key] for chunk in chunks]) for key in rows.keys()}
+            # every chunk is sorted, the rows stay sorted as long as the file is time ordered
+            if any(len(a['Timestamp']) and a['Timestamp'][-1] > b['Timestamp'][0]
+                   for a, b in zip(chunks[:-1], chunks[1:])):
+                order = np.argsort(rows['Timestamp'], kind='stable')
+                rows = {key: column[order] for key, column in rows.items()}
+            self._spike_rows[ch_id] = rows
+        if ch_id in self._spike_rows.keys():
+            return self._spike_rows[ch_id]
+        spikes = self._spike_slices.get(ch_id, slice(0, 0))
+        return {key: column[spikes] for key, column in self._spikes.items()}
+
+    def _merge_spike_tail(self):
+        """ Merge the rows appended by refresh into the spike table, for queries over all electrodes """
+        if self._spikes is None:
+            self._set_spikes()
+        if not len(self._spike_tail) and not len(self._spike_rows):
+            return
+        electrodes = sorted(set(self._spike_slices.keys()) | set(self._spike_rows.keys()) |
+                            set(self._spike_tail.keys()))
+        rows = [self._get_spike_rows(eid) for eid in electrodes]
+        self._set_spikes({key: np.concatenate([r[key] for r in rows]) for key in self._spikes.keys()})
+
+    def _get_event_index(self, packet_id):
+        """ Packet indices of an event type, merging the groups appended by refresh """
+        if packet_id in self._events_tail.keys():
+            chunks = self._events_tail.pop(packet_id)
+            if packet_id in self._events_map.keys():
+                chunks.insert(0, self._events_map[packet_id])
+            self._events_map[packet_id] = np.concatenate(chunks)
+        return self._events_map.get(packet_id)
+
+    def _decode_event_packets(self, index, layout, tail=None):
+        """ Decode the given data packets through a structured dtype laid over the mmap
+        Parameters:
+            index: packet indices
+            layout: HeaderLayout of the payload following the packet header
+            tail: optional (Field, dtype) filling the rest of the packet ('S' for text)
+        Returns:
+            dict of columns (text columns as lists of str)
+        """
+        dpacket_size = self.BasicHeader['Bytes_in_DataPackets']
+        header = np.dtype(NEV_PACKET_HEADER)
+        names = list(header.names) + layout.Field
+        formats = [header.fields[name][0] for name in header.names] + \
+                  [layout.dtype.fields[name][0] for name in layout.Field]
+        offsets = [header.fields[name][1] for name in header.names] + \
+                  [NEV_PACKET_HEADER_SIZE + layout.dtype.fields[name][1] for name in layout.Field]
+
+        rest = dpacket_size - NEV_PACKET_HEADER_SIZE - layout.size
+        if rest < 0:
             raise Exception
+        if tail is not None and rest > 0:
+            if tail[1] == 'S':
+                formats.append('S{}'.format(rest))
+            else:
+                formats.append((tail[1], rest // np.dtype(tail[1]).itemsize))
+            names.append(tail[0])
+            offsets.append(NEV_PACKET_HEADER_SIZE + layout.size)
+
+        dtype = np.dtype(dict(names=names, formats=formats, offsets=offsets, itemsize=dpacket_size))
+        view = np.frombuffer(self._fileobj, dtype=dtype, count=len(self._packets),
+                             offset=self.BasicHeader['Bytes_in_Headers'])
+        records = view[index]
+        count('nev.packets_decoded', len(records))
+        count('nev.bytes_read', len(records) * dpacket_size)
+        del view
+
+        output = dict()
+        for name in names:
+            if name == 'Packet_ID':
+                continue
+            column = records[name]
+            if column.dtype.kind == 'S':
+                column = [v.decode('latin-1').split('\x00', 1)[0] for v in column]
+            output[name] = column
+        return output
 
-        output['Waveform'].append(np.frombuffer(data_packet[8:],
-                                                dtype=data_type,
-                                                count=spike_width).astype(np.int32))
+    def _set_tracking_info(self, output):
+        """ Attach TrackableType and coordinate dimensions from the TRACKOBJ headers """
+        node_id = output['Node_ID']
+        output['Trackable_Type'] = np.zeros(len(node_id), dtype=np.uint16)
+        output['Dimensions'] = np.full(len(node_id), 2, dtype=np.uint8)
+        for header in self.ExtendedRecords.get('TRACKOBJ', []):
+            mask = node_id == header['TrackableID']
+            output['Trackable_Type'][mask] = header['TrackableType']
+            output['Dimensions'][mask] = TRACKABLE_DIMENSIONS.get(header['TrackableType'], 2)
         return output
 
-    @disk_cache('_event', _cache_dir, method=True)
+    def _set_video_source_info(self, output):
+        """ Attach source name and frame rate from the VIDEOSYN headers """
+        source_id = output['Source_ID']
+        output['Frame_Rate'] = np.full(len(source_id), np.nan, dtype=np.float32)
+        output['Video_Source'] = [''] * len(source_id)
+        for header in self.ExtendedRecords.get('VIDEOSYN', []):
+            mask = source_id == header['VideoSourceID']
+            output['Frame_Rate'][mask] = header['FrameRate']
+            for i in np.flatnonzero(mask).tolist():
+                output['Video_Source'][i] = header['VideoSource']
+        return output
+
+    @disk_cache('_event_columns', _cache_dir, method=True)
     def _parse_events(self, packet_id, path):
-        if packet_id not in self.avail_events:
+        index = self._get_event_index(packet_id)
+        if index is None or packet_id not in NEV_EVENT_LAYOUTS.keys():
             return None
         else:
-            dpacket_size = self.BasicHeader['Bytes_in_DataPackets']
-            output = dict()
-            for loc in self._events_map[packet_id]:
-                data_packet = self._fileobj[loc:loc + dpacket_size]
-                if packet_id == 'Digital_Events':
-                    output = self._parse_digital_input(output, data_packet)
-                elif packet_id == 'Comment_Events':
-                    output = self._parse_comment_event(output, data_packet)
-                elif 1 <= packet_id <= 2048:
-                    output = self._parse_spike_event(output, data_packet)
-                else:
-                    # Need integrate rest of event type
-                    output = None
+            layout, tail = NEV_EVENT_LAYOUTS[packet_id]
+            output = self._decode_event_packets(index, layout, tail)
+            if packet_id == 'Tracking_Event':
+                output = self._set_tracking_info(output)
+            elif packet_id == 'Video_Sync_Event':
+                output = self._set_video_source_info(output)
             return output
 
-    def _set_events(self, packet_id):
-        self._events[packet_id] = self._parse_events(packet_id, os.path.basename(self._path))
+    def _get_events(self, packet_id):
+        # decoded columns are held by the shared memory tier of disk_cache
+        return self._parse_events(packet_id, os.path.basename(self._path))
 
     def get_comment_events(self):
-        # TODO: need more consistant output format
-        if 'Comment_Events' not in self._events.keys():
-            self._set_events('Comment_Events')
-        return self._events['Comment_Events']
+        return self._get_events('Comment_Events')
 
     def get_digital_events(self):
-        # TODO: need more consistant output format
-        if 'Digital_Events' not in self._events.keys():
-            self._set_events('Digital_Events')
-        return self._events['Digital_Events']
+        return self._get_events('Digital_Events')
+
+    def get_video_sync_events(self):
+        """ Video sync events with File_Number, Frame_Number, Elapsed_Time, Source_ID,
+        and Video_Source / Frame_Rate from the VIDEOSYN headers
+        """
+        return self._get_events('Video_Sync_Event')
+
+    def get_tracking_events(self):
+        """ Tracking events with Parent_ID, Node_ID, Node_Count, Point_Count, raw Points
+        and Trackable_Type / Dimensions from the TRACKOBJ headers
+        """
+        return self._get_events('Tracking_Event')
+
+    def get_tracking_points(self, node_id):
+        """
+        Parameters:
+            node_id: TrackableID of the tracked object
+        Returns:
+            tstamps: Event timestamps (unit: TimeStamp_Resolution ticks)
+            n_points: number of valid points in each event
+            points: coordinates (n_events, max_points, n_dimensions), valid up to n_points
+        """
+        events = self.get_tracking_events()
+        if events is None:
+            return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint16), np.zeros((0, 0, 2), dtype=np.uint16)
+        mask = events['Node_ID'] == node_id
+        dims = int(events['Dimensions'][mask][0]) if mask.any() else 2
+        points = events['Points'][mask]
+        max_points = points.shape[1] // dims
+        return events['Timestamp'][mask], events['Point_Count'][mask], \
+            points[:, :max_points * dims].reshape(-1, max_points, dims)
+
+    def get_button_trigger_events(self):
+        return self._get_events('Button_Trigger_Event')
+
+    def get_log_events(self):
+        return self._get_events('Log_Event')
+
+    def get_configuration_events(self):
+        return self._get_events('Configuration_Event')
 
     def get_spike_unit_cls(self, ch_id):
         """ Spike Unit Classification
@@ -260,9 +553,7 @@ class openNEV(BaseLoader):
         Returns:
             unit_cls: Spike unit classification indices on given channel (unit: sec)
         """
-        if ch_id not in self._events.keys():
-            self._set_events(ch_id)
-        return np.asarray(self._events[ch_id]['Unit_Classification'])
+        return self._get_spike_rows(ch_id)['Unit_Classification']
 
     def get_spike_timestamp(self, ch_id, idx=True):
         """
@@ -271,34 +562,179 @@ class openNEV(BaseLoader):
         Returns:
             tstamps: Event timestamps on given channel (unit: sec)
         """
-        if ch_id not in self._events.keys():
-            self._set_events(ch_id)
+        tstamps = self._get_spike_rows(ch_id)['Timestamp']
         fs = self.BasicHeader['TimeStamp_Resolution']
         if idx:
-            return self._events[ch_id]['Timestamp']
+            return tstamps
         else:
-            return np.asarray(self._events[ch_id]['Timestamp']) / fs
+            return tstamps / fs
 
-    def get_spike_waveforms(self, ch_id):
+    def get_spike_waveforms(self, ch_id, index=None, scale=False):
         """
         Parameters:
             ch_id:
+            index: indices (or boolean mask) of the spikes to return (default: all spikes)
+            scale: multiply by Digitization_Factor (unit: nV), otherwise raw digital values
         Returns:
             x: time axis (unit: msec)
-            Y: Waveform (n_samples, n_features) (unit: nV)
+            Y: Waveform (n_samples, n_features), gathered from the mmap for the selected spikes only
         """
-        if ch_id not in self._events.keys():
-            self._set_events(ch_id)
-        # TODO: x axis need to be returned
+        packet_index = self._get_spike_rows(ch_id)['Packet_Index']
+        if index is not None:
+            packet_index = packet_index[index]
+
         time_resol = self.BasicHeader['Sample_Time_Resolution']
         n_sample = self.ExtendedHeader[ch_id]['Spike_Width_Samples']
         x = np.linspace(start=0, stop=n_sample / time_resol, num=n_sample) * 1000
 
-        return x, np.asarray(self._events[ch_id]['Waveform'])
+        waveform = self._waveforms[packet_index]
+        count('nev.bytes_read', waveform.nbytes)
+        if self.ExtendedHeader[ch_id]['Bytes_Per_Waveform'] <= 1:
+            waveform = waveform.view(np.int8)
+        elif self.ExtendedHeader[ch_id]['Bytes_Per_Waveform'] != 2:
+            raise Exception
+        waveform = waveform[:, :n_sample]
+
+        if scale:
+            waveform = waveform * float(self.ExtendedHeader[ch_id]['Digitization_Factor'])
+        return x, waveform
+
+    def get_spikes(self, ch_ids, t0=None, t1=None, waveforms=False, scale=False):
+        """ Spikes of the given channels within a time window, located by binary search
+        Parameters:
+            ch_ids: channel ID or list of channel IDs
+            t0: window start, inclusive (unit: sec)
+            t1: window stop, exclusive (unit: sec)
+            waveforms: also return the waveforms of the selected spikes
+            scale: multiply waveforms by Digitization_Factor (unit: nV)
+        Returns:
+            dict of {ch_id: dict(Timestamp, Unit_Classification[, Waveform])},
+            timestamps in TimeStamp_Resolution ticks
+        """
+        if isinstance(ch_ids, (int, np.integer)):
+            ch_ids = [ch_ids]
+        fs = self.BasicHeader['TimeStamp_Resolution']
+        output = dict()
+        for ch_id in ch_ids:
+            spikes = self._get_spike_rows(ch_id)
+            tstamps = spikes['Timestamp']
+            start = 0 if t0 is None else int(np.searchsorted(tstamps, np.ceil(t0 * fs), side='left'))
+            stop = len(tstamps) if t1 is None else int(np.searchsorted(tstamps, np.ceil(t1 * fs), side='left'))
+            output[ch_id] = dict(Timestamp=tstamps[start:stop],
+                                 Unit_Classification=spikes['Unit_Classification'][start:stop])
+            if waveforms:
+                output[ch_id]['Waveform'] = self.get_spike_waveforms(ch_id, index=slice(start, stop), scale=scale)[1]
+        return output
+
+    def get_spike_epochs(self, times, pre, post, channels=None, units=None):
+        """ Event-aligned spike times, located for all events at once by binary search
+        Parameters:
+            times: event times (unit: sec)
+            pre: window length before each event (unit: sec)
+            post: window length after each event (unit: sec)
+            channels: list of channel IDs (default: all channels)
+            units: list of unit classifications to keep (default: all units)
+        Returns:
+            dict of {ch_id: dict(Trial, Time, Unit_Classification)}, with Trial the event
+            index and Time the spike time relative to the event (unit: sec)
+        """
+        if channels is None:
+            channels = list(self._channel_index)
+        fs = float(self.BasicHeader['TimeStamp_Resolution'])
+        times = np.asarray(times, dtype=np.float64).reshape(-1)
+        lower = np.ceil((times - pre) * fs)
+        upper = np.ceil((times + post) * fs)
+
+        output = dict()
+        for ch_id in channels:
+            spikes = self._get_spike_rows(ch_id)
+            tstamps = spikes['Timestamp']
+            start = np.searchsorted(tstamps, lower, side='left')
+            counts = np.searchsorted(tstamps, upper, side='left') - start
+            trial = np.repeat(np.arange(len(times)), counts)
+            index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + \
+                np.repeat(start, counts)
+            unit = spikes['Unit_Classification'][index]
+            rel_time = tstamps[index] / fs - times[trial]
+            if units is not None:
+                mask = np.isin(unit, units)
+                trial, rel_time, unit = trial[mask], rel_time[mask], unit[mask]
+            output[ch_id] = dict(Trial=trial, Time=rel_time, Unit_Classification=unit)
+        return output
+
+    def get_epochs(self, event_ts, pre, post, channels=None, units=None,
+                   nsx=None, nsx_channels=None, dtype=None):
+        """ Event-aligned spikes and, optionally, continuous epochs from an openNSx of the same session
+        Parameters:
+            event_ts: event timestamps (unit: TimeStamp_Resolution ticks, e.g. from get_digital_events)
+            pre: window length before each event (unit: sec)
+            post: window length after each event (unit: sec)
+            channels: list of spike channel IDs (default: all channels)
+            units: list of unit classifications to keep (default: all units)
+            nsx: openNSx object to gather continuous epochs from
+            nsx_channels: list of NSx channel IDs (default: all channels)
+            dtype: output dtype of the continuous epochs (e.g. np.float32)
+        Returns:
+            dict(Spikes=get_spike_epochs output[, Continuous=(xp, epochs (n_events, n_channels, n_samples))])
+        """
+        times = np.asarray(event_ts, dtype=np.float64).reshape(-1) / self.BasicHeader['TimeStamp_Resolution']
+        output = dict(Spikes=self.get_spike_epochs(times, pre, post, channels=channels, units=units))
+        if nsx is not None:
+            output['Continuous'] = nsx.get_epochs(times, pre, post, ch_ids=nsx_channels, dtype=dtype)
+        return output
+
+    def bin_spikes(self, bin_size, t0=None, t1=None, channels=None, units=None, sparse=False):
+        """ Spike count matrix in one vectorized pass over the columnar spike table
+        Parameters:
+            bin_size: bin width (unit: sec)
+            t0: start of the first bin (unit: sec, default: 0)
+            t1: end of the binned range (unit: sec, default: last spike), a partial last bin is extended
+            channels: list of channel IDs, one row each (default: all channels)
+            units: list of unit classifications to count (default: all units)
+            sparse: return a scipy.sparse.csr_matrix instead of a dense array
+        Returns:
+            edges: bin edges (n_bins + 1,) (unit: sec)
+            counts: spike counts (n_channels, n_bins)
+        """
+        self._merge_spike_tail()
+        if bin_size <= 0:
+            raise Exception
+        fs = float(self.BasicHeader['TimeStamp_Resolution'])
+        if channels is None:
+            channels = list(self._channel_index)
+        tstamps = self._spikes['Timestamp']
+        if t0 is None:
+            t0 = 0.0
+        if t1 is None:
+            t1 = (int(tstamps.max()) + 1) / fs if len(tstamps) else t0
+        n_bins = max(int(np.ceil(round((t1 - t0) / bin_size, 9))), 0)
+        edges = t0 + np.arange(n_bins + 1) * bin_size
+
+        # row of each spike, -1 for channels that are not requested
+        lut = np.full(max(int(self._spikes['Electrode'].max()) if len(tstamps) else 0,
+                          max(channels) if len(channels) else 0) + 1, -1, dtype=np.int64)
+        lut[np.asarray(channels, dtype=np.int64)] = np.arange(len(channels))
+        rows = lut[self._spikes['Electrode']]
+        cols = np.floor((tstamps - t0 * fs) / (bin_size * fs)).astype(np.int64)
+        mask = (rows >= 0) & (cols >= 0) & (cols < n_bins)
+        if units is not None:
+            mask &= np.isin(self._spikes['Unit_Classification'], units)
+        rows = rows[mask]
+        cols = cols[mask]
+
+        if sparse:
+            from scipy.sparse import coo_matrix
+            counts = coo_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                shape=(len(channels), n_bins)).tocsr()
+        else:
+            counts = np.bincount(rows * n_bins + cols,
+                                 minlength=len(channels) * n_bins).reshape(len(channels), n_bins)
+        return edges, counts
 
     def close(self):
-        if self._fileobj is not None:
-            self._fileobj.close()
+        self._packets = None
+        self._waveforms = None
+        self._close_map(self._fileobj)
 
     def __del__(self):
         self.close()
@@ -1,11 +1,10 @@
 import os
 from . import *
-from .utils import disk_cache, hashlib
+from .utils import mapped_fingerprint, hashlib
+from .metrics import profiled, stage, count
 
 
 class openNSx(BaseLoader):
-    _cache_dir = os.path.join(os.curdir, '_bmcache_')
-
     def __init__(self, path=None):
         super(openNSx, self).__init__()
         self._fileobj = None
@@ -25,8 +24,9 @@ class openNSx(BaseLoader):
         self.TimeStamp = None
         self.NumDataPoints = None
         self.TotalDataPoints = None
-        self.ChannelMap = None
         self.NumChannels = None
+        self.Segments = None
+        self._data = None
 
         if path != None:
             self.load(path)
@@ -37,37 +37,37 @@ class openNSx(BaseLoader):
     # def load(self, path):
     #     self._fileobj = open(path, 'rb')
 
-    def load(self, path):
+    @profiled('nsx.open')
+    def load(self, path, fingerprint=True):
+        """ Map the file read-only
+        Parameters:
+            path: file path
+            fingerprint: hash the first bytes of the map to key disk_cache entries
+                         (skipped by header-only readers such as the catalog)
+        """
         import mmap
         with open(path, 'rb') as f:
             self._path = path
+            stat = os.fstat(f.fileno())
             self._fileobj = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         self._filesize = len(self._fileobj)
+        self._fingerprint = mapped_fingerprint(self._fileobj, stat) if fingerprint else None
         self._path_hash = int(hashlib.sha1(self._path.encode('utf-8')).hexdigest(), 16) % (10 ** 8)
 
+    @profiled('nsx.basic_header')
     def _parse_basic_header(self):
         if self._fileobj == None:
             raise Exception
 
         if self.BasicHeader == None:
-            # self._fileobj.seek(0, 0)
-            self.BasicHeader = dict()
-            bh_size = self.NEURALCD.Bytes.sum()
-            bh_data = self._fileobj[0:bh_size]
-            # f = self._fileobj
-            loc = 0
-            for i, row in self.NEURALCD.iterrows():
-                c, loc = self.decoding(bh_data, row.Type, loc, row.Bytes)
-                # c = decoding(f, row.Type, row.Bytes)
-                if row.Field == 'File_Spec':
-                    c = "{}.{}".format(*c)
-                elif row.Field == 'Time_Origin':
-                    c = convert_winsystime_struct(c)
-                self.BasicHeader[row.Field] = c
+            self.BasicHeader = self.NEURALCD.unpack(self._fileobj)
+            self.BasicHeader['File_Spec'] = "{}.{}".format(*self.BasicHeader['File_Spec'])
+            self.BasicHeader['Time_Origin'] = convert_winsystime_struct(self.BasicHeader['Time_Origin'])
             self.SamplingFreq = self.BasicHeader['Time_Resolution_of_Time_Stamps'] / self.BasicHeader['Period']
         else:
             pass
 
+    @profiled('nsx.extended_header')
     def _parse_extended_header(self):
         if self._fileobj == None:
             raise Exception
@@ -76,64 +76,131 @@ class openNSx(BaseLoader):
             self._parse_basic_header()
 
         if self.ExtendedHeader == None:
-            self._fileobj.seek(self.NEURALCD.Bytes.sum(), 0)
-            f = self._fileobj
             self.ExtendedHeader = dict()
-            for ch in range(self.BasicHeader['Channel_Count']):
-                header = dict()
-                for i, row in self.CC.iterrows():
-                    header[row.Field] = decoding(f, row.Type, row.Bytes)
-
-                eid = header['Electrode_ID']
-                self.ExtendedHeader[eid] = header
+            records = self.CC.frombuffer(self._fileobj, count=self.BasicHeader['Channel_Count'],
+                                         offset=self.NEURALCD.size)
+            for header in self.CC.to_records(records):
+                self.ExtendedHeader[header['Electrode_ID']] = header
+            del records
         self.check_channel_map('Electrode_Label')
 
+    @profiled('nsx.data_header')
     def parse_data_header(self):
+        """ Build the index of data packets (segments) found in the file
+        each recording pause/resume or clock reset starts a new data packet with its own
+        header, so the index holds byte offset, timestamp and length of every packet
+        together with its start sample on the global timeline
+        """
         if self.ExtendedHeader == None:
             self._parse_extended_header()
 
-        self._fileobj.seek(self.BasicHeader['Bytes_in_Headers'])
-
-        f = self._fileobj
-        for i, row in self.Data.iterrows():
-            if row.Field == 'Data_Point':
-                pass
+        segments = self._scan_packets(self.BasicHeader['Bytes_in_Headers'], 0)
+        if not len(segments):
+            raise Exception
+        count('nsx.packets', len(segments))
+        self._set_segments(segments)
+
+    def _scan_packets(self, loc, end):
+        """ Walk the data packet headers from byte offset loc to the end of the mapped file
+        Parameters:
+            loc: byte offset of a packet header
+            end: end sample of the packets preceding loc
+        Returns:
+            list of (Offset, Timestamp, Num_Data_Points, Start)
+        """
+        hdr = struct.Struct('<' + ''.join(self.Data.Type[:3]))
+        hdr_size = hdr.size
+        frame_size = int(self.Data.Bytes[3]) * self.NumChannels
+        period = int(self.BasicHeader['Period'])
+
+        segments = []
+        while loc + hdr_size <= self._filesize:
+            header, timestamp, num_dp = hdr.unpack_from(self._fileobj, loc)
+            if header != 1:
+                raise Exception(header)
+            loc += hdr_size
+            # the last packet may be truncated when the file was not closed properly
+            num_dp = min(num_dp, (self._filesize - loc) // frame_size)
+            start = max(int(timestamp // period), end)
+            segments.append((loc, timestamp, num_dp, start))
+            loc += num_dp * frame_size
+            end = start + num_dp
+        return segments
+
+    def _set_segments(self, segments):
+        self.Segments = np.array(segments, dtype=[('Offset', np.int64),
+                                                  ('Timestamp', np.int64),
+                                                  ('Num_Data_Points', np.int64),
+                                                  ('Start', np.int64)])
+        self.TimeStamp = int(self.Segments['Timestamp'][0])
+        self.NumDataPoints = int(self.Segments['Num_Data_Points'].sum())
+        self.TotalDataPoints = int(self.Segments['Start'][-1] + self.Segments['Num_Data_Points'][-1])
+        self._parse_data_view()
+
+    def refresh(self):
+        """ Pick up samples appended to a file that is still being recorded
+        the file is mapped again and only the last (possibly incomplete) data packet and
+        the packets appended after it are scanned, earlier packets are left untouched
+        Returns:
+            number of samples added to the timeline
+        """
+        if not self._remap():
+            return 0
+        total = self.TotalDataPoints
+        last = self.Segments[-1]
+        end = int(self.Segments['Start'][-2] + self.Segments['Num_Data_Points'][-2]) if len(self.Segments) > 1 else 0
+        hdr_size = self.Data.size - int(self.Data.Bytes[3])
+        segments = self._scan_packets(int(last['Offset']) - hdr_size, end)
+        count('nsx.packets', len(segments) - 1)
+        self._set_segments(self.Segments[:-1].tolist() + segments)
+        return self.TotalDataPoints - total
+
+    def follow(self, channels=None, poll_interval=0.001, timeout=None, dtype=None, raw=False):
+        """ Yield the samples appended to a file that is still being recorded
+        Parameters:
+            channels: list of channel IDs (default: all channels)
+            poll_interval: delay between checks of the file size (unit: sec)
+            timeout: stop after this long without new samples (unit: sec, default: never)
+            dtype: output dtype of the scaled data (e.g. np.float32)
+            raw: yield unscaled digital values
+        Yields:
+            xp: time axis of the new samples (unit: sec)
+            yp: new data (n_channels, n_new_samples)
+        """
+        import time
+        ch_ids = list(self._channel_index) if channels is None else channels
+        idle = time.monotonic()
+        while True:
+            i0 = self.TotalDataPoints
+            if self.refresh():
+                idle = time.monotonic()
+                yield self._read_window(ch_ids, i0, self.TotalDataPoints, dtype=dtype, raw=raw)
+            elif timeout is not None and time.monotonic() - idle > timeout:
+                return
             else:
-                c = struct.unpack(row.Type, f.read(int(row.Bytes)))[0]
-                if row.Field == 'Header':
-                    if c != 1:
-                        raise Exception(c)
-                if row.Field == 'Timestamp':
-                    self.TimeStamp = c
-                elif row.Field == 'Number_of_Data_Points':
-                    self.NumDataPoints = c
-        self.TotalDataPoints = self.TimeStamp + self.NumDataPoints
-
-    @disk_cache(f'_ch_data', _cache_dir, method=True)
-    def _parse_data(self, ch_id, path):
-        dp_size = self.Data.Bytes[3]
-        dp_type = self.Data.Type[3]
-        loc = self.BasicHeader['Bytes_in_Headers'] + self.Data.Bytes[:3].sum()
-        ch_index = int(self.ChannelMap.index[self.ChannelMap['ID'] == ch_id].tolist()[0])
-        n_zpad = int(self.TimeStamp)
-        fs = float(self.SamplingFreq)
-
-        data = []
-        if n_zpad < 0:
-            n_zpad = 0
-        if n_zpad != 0:
-            data.extend([0] * n_zpad)
-
-        stop = self.TotalDataPoints
-        dp_index = np.arange(ch_index, int(self.NumDataPoints * self.NumChannels), self.NumChannels)
-
-        for dp in dp_index:
-            self._fileobj.seek(loc + (dp * dp_size))
-            data.append(struct.unpack(dp_type, self._fileobj.read(dp_size))[0])
-
-        xp = np.linspace(0, stop / fs, len(data))
-        yp = np.asarray(data)
-
+                time.sleep(poll_interval)
+
+    def _parse_data_view(self):
+        """ Zero-copy views of each data packet over the mmap, shaped (samples, channels) """
+        dtype = '<{}'.format(self.Data.Type[3])
+        self._data = [np.frombuffer(self._fileobj, dtype=dtype,
+                                    count=int(seg['Num_Data_Points'] * self.NumChannels),
+                                    offset=int(seg['Offset'])).reshape(-1, self.NumChannels)
+                      for seg in self.Segments]
+
+    def _get_channel_index(self, ch_id):
+        return self._channel_index[ch_id]
+
+    def _check_channels(self, ch_ids):
+        """ Raise KeyError with the first channel ID missing from the file """
+        for ch_id in ch_ids:
+            if ch_id not in self._channel_index:
+                raise KeyError(ch_id)
+
+    def get_scale_from_channel(self, ch_id):
+        """ Linear (gain, offset) pair mapping raw digital values to analog units
+        (analog = raw * gain + offset), used to scale reads made with raw=True
+        """
         max_dv = self.ExtendedHeader[ch_id]['Max_Digital_Value']
         min_dv = self.ExtendedHeader[ch_id]['Min_Digital_Value']
         bias_dv = (max_dv + min_dv) / 2.0
@@ -145,93 +212,303 @@ class openNSx(BaseLoader):
         centered_max_dv = max_dv - bias_dv
         centered_max_ac = max_av - bias_av
 
-        yp = ((yp - bias_av) / (float(centered_max_dv) / float(centered_max_ac))) + bias_av
-        return xp, yp
+        gain = float(centered_max_ac) / float(centered_max_dv)
+        return gain, bias_av - bias_av * gain
 
-    def get_data_from_channel(self, ch_id, start=None, stop=None,
-                              down_sampling=None):
-        if ch_id not in self.ChannelMap['ID'].values:
-            raise Exception # TODO: Exception string handling
+    def _get_sample_range(self, start=None, stop=None):
+        """ Convert a [start, stop] time window (unit: sec) into a half-open sample range """
+        fs = float(self.SamplingFreq)
+        i0 = 0 if start == None else int(np.ceil(round(start * fs, 6)))
+        i1 = self.TotalDataPoints if stop == None else int(np.floor(round(stop * fs, 6))) + 1
+        i0 = min(max(i0, 0), self.TotalDataPoints)
+        i1 = min(max(i1, i0), self.TotalDataPoints)
+        return i0, i1
+
+    def _get_output_dtype(self, dtype=None, raw=False):
+        if raw:
+            return self._data[0].dtype
+        if dtype is None:
+            return np.float64
+        # gain and offset are fractional, scaled data only fits a floating dtype
+        if not np.issubdtype(np.dtype(dtype), np.floating):
+            raise Exception(dtype)
+        return np.dtype(dtype)
+
+    def _read_window(self, ch_ids, i0, i1, dtype=None, raw=False, out=None):
+        """ Read and scale the sample range [i0, i1) of the given channels
+        only the segments overlapping the range are located by binary search and only the
+        corresponding byte ranges are touched, samples not covered by any segment
+        (before the first timestamp or during pauses) are zero-padded arithmetically
+        compact reads (dtype or raw given) return a lazy TimeAxis, and raw windows lying in
+        a single segment are returned as int16 views of the mmap without copying
+        out: optional zero-initialized (n_channels, i1 - i0) array to be filled in place
+        """
+        ch_indices = [self._get_channel_index(ch_id) for ch_id in ch_ids]
+        fs = float(self.SamplingFreq)
 
-        xp, yp = self._parse_data(ch_id, os.path.basename(self._path))
+        starts = self.Segments['Start']
+        ends = starts + self.Segments['Num_Data_Points']
+        first = int(np.searchsorted(ends, i0, side='right'))
+        last = int(np.searchsorted(starts, i1, side='left'))
+
+        if raw and out is None:
+            if last - first == 1 and starts[first] <= i0 and i1 <= ends[first] and len(ch_indices):
+                view = self._data[first][i0 - starts[first]:i1 - starts[first]]
+                if (np.diff(ch_indices) == 1).all():
+                    return TimeAxis(i0, i1 - i0, fs), view[:, ch_indices[0]:ch_indices[-1] + 1].T
+                return TimeAxis(i0, i1 - i0, fs), view[:, ch_indices].T
+        if out is None:
+            yp = np.zeros((len(ch_indices), i1 - i0), dtype=self._get_output_dtype(dtype, raw))
+        else:
+            yp = out
+
+        with stage('nsx.read'):
+            for seg in range(first, last):
+                d0 = max(i0, int(starts[seg]))
+                d1 = min(i1, int(ends[seg]))
+                if d1 > d0:
+                    yp[:, d0 - i0:d1 - i0] = self._data[seg][d0 - starts[seg]:d1 - starts[seg], ch_indices].T
+                    count('nsx.bytes_read', (d1 - d0) * len(ch_indices) * self._data[seg].itemsize)
+        if raw:
+            return TimeAxis(i0, i1 - i0, fs), yp
+
+        with stage('nsx.scale'):
+            scales = np.asarray([self.get_scale_from_channel(ch_id) for ch_id in ch_ids],
+                                dtype=yp.dtype).reshape(-1, 2)
+            yp *= scales[:, :1]
+            yp += scales[:, 1:]
+        if dtype is None:
+            return np.arange(i0, i1) / fs, yp
+        return TimeAxis(i0, i1 - i0, fs), yp
+
+    def get_data_from_channel(self, ch_id, start=None, stop=None,
+                              down_sampling=None, dtype=None, raw=False):
+        """
+        Parameters:
+            ch_id: channel ID
+            start: start time (unit: sec)
+            stop: stop time (unit: sec)
+            down_sampling: integer decimation factor, or float resampling factor
+            dtype: output dtype of the scaled data (e.g. np.float32)
+            raw: return unscaled digital values (see get_scale_from_channel)
+        Returns:
+            xp: time axis (unit: sec), a lazy TimeAxis when dtype or raw is given
+            yp: data (n_samples,)
+        """
+        self._check_channels([ch_id])
+
+        if dtype is not None or raw:
+            if down_sampling != None:
+                raise Exception
+            Xp, Yp = self._read_window([ch_id], *self._get_sample_range(start, stop), dtype=dtype, raw=raw)
+            return Xp, Yp[0]
 
-        if start == None:
-            start = xp[0]
-        if stop == None:
-            stop = xp[-1]
+        if down_sampling != None and isinstance(down_sampling, (int, np.integer)):
+            # integer factor, streaming FIR decimation over the mmap
+            Xp, Yp = self.get_data_from_channels([ch_id], start, stop, down_sampling=down_sampling)
+            return Xp, Yp[0]
 
-        Xp = xp[(xp >= start) & (xp <= stop)]
-        Yp = yp[(xp >= start) & (xp <= stop)]
+        # a full read is a single strided pass over the mmap, not worth a cache entry
+        Xp, Yp = self._read_window([ch_id], *self._get_sample_range(start, stop))
+        Yp = Yp[0]
 
         if down_sampling != None:
-            if isinstance(down_sampling, (int, float)):
+            if isinstance(down_sampling, float):
                 from scipy.signal import resample
                 Yp, Xp = resample(Yp, int(Xp.shape[0]/down_sampling), t=Xp)
             else:
                 raise Exception
         return Xp, Yp
 
+    def get_data_from_channels(self, ch_ids, start=None, stop=None, down_sampling=None,
+                               dtype=None, raw=False, workers=None):
+        """ Batch read of multiple channels in one sequential pass over the data packet
+        Parameters:
+            ch_ids: list of channel IDs
+            start: start time (unit: sec)
+            stop: stop time (unit: sec)
+            down_sampling: integer decimation factor (see iter_decimate)
+            dtype: output dtype of the scaled data (e.g. np.float32)
+            raw: return unscaled digital values (see get_scale_from_channel)
+            workers: number of threads sharing the mmap (default: serial read)
+        Returns:
+            xp: time axis (unit: sec), a lazy TimeAxis when dtype or raw is given
+            yp: data (n_channels, n_samples)
+        """
+        self._check_channels(ch_ids)
+        if down_sampling != None:
+            if dtype is not None or raw:
+                raise Exception
+            blocks = list(self.iter_decimate(down_sampling, channels=ch_ids, start=start, stop=stop))
+            if not len(blocks):
+                return np.zeros(0), np.zeros((len(ch_ids), 0))
+            return np.concatenate([b[0] for b in blocks]), np.concatenate([b[1] for b in blocks], axis=1)
+        i0, i1 = self._get_sample_range(start, stop)
+        if workers != None and workers > 1:
+            return self._read_window_parallel(ch_ids, i0, i1, workers, dtype=dtype, raw=raw)
+        return self._read_window(ch_ids, i0, i1, dtype=dtype, raw=raw)
+
+    def _read_window_parallel(self, ch_ids, i0, i1, workers, dtype=None, raw=False):
+        """ Split [i0, i1) into contiguous sample ranges filled by a thread pool
+        each thread copies and scales its own byte range of the shared mmap into a slice
+        of a single output array, NumPy releases the GIL during these copies
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        yp = np.zeros((len(ch_ids), i1 - i0), dtype=self._get_output_dtype(dtype, raw))
+        bounds = np.linspace(i0, i1, int(workers) + 1).astype(np.int64)
+
+        def fill(k):
+            a, b = int(bounds[k]), int(bounds[k + 1])
+            if b > a:
+                self._read_window(ch_ids, a, b, dtype=dtype, raw=raw, out=yp[:, a - i0:b - i0])
+
+        with ThreadPoolExecutor(max_workers=int(workers)) as pool:
+            list(pool.map(fill, range(int(workers))))
+        if dtype is None and not raw:
+            return np.arange(i0, i1) / float(self.SamplingFreq), yp
+        return TimeAxis(i0, i1 - i0, self.SamplingFreq), yp
+
+    def _iter_windows(self, channels, i0, i1, chunk_samples, overlap=0, dtype=None, raw=False):
+        for pos in range(i0, i1, int(chunk_samples)):
+            yield self._read_window(channels, max(i0, pos - int(overlap)), min(i1, pos + int(chunk_samples)),
+                                    dtype=dtype, raw=raw)
+
+    def iter_chunks(self, chunk_samples, overlap=0, channels=None, start=None, stop=None,
+                    dtype=None, raw=False):
+        """ Stream scaled blocks straight from the mmap with bounded memory
+        Parameters:
+            chunk_samples: number of new samples per block
+            overlap: number of samples from the previous block prepended to each block
+            channels: list of channel IDs (default: all channels)
+            start: start time (unit: sec)
+            stop: stop time (unit: sec)
+            dtype: output dtype of the scaled data (e.g. np.float32)
+            raw: yield unscaled digital values (see get_scale_from_channel)
+        Yields:
+            xp: time axis of the block (unit: sec)
+            yp: data (n_channels, n_samples)
+        """
+        if chunk_samples <= 0 or overlap < 0:
+            raise Exception
+        if channels is None:
+            channels = list(self._channel_index)
+        self._check_channels(channels)
+
+        i0, i1 = self._get_sample_range(start, stop)
+        for block in self._iter_windows(channels, i0, i1, chunk_samples, overlap, dtype=dtype, raw=raw):
+            yield block
+
+    def iter_decimate(self, factor, channels=None, start=None, stop=None,
+                      chunk_samples=65536, numtaps=None):
+        """ Stream anti-aliased decimation by an integer factor with bounded memory
+        a linear-phase FIR low-pass (cutoff at the new Nyquist) is evaluated only at the
+        retained output samples (polyphase, scipy.signal.upfirdn), chunk by chunk with the filter history
+        carried between chunks; the delay is compensated and both ends are
+        extended with the edge value instead of wrapping around
+        Parameters:
+            factor: integer decimation factor
+            channels: list of channel IDs (default: all channels)
+            start: start time (unit: sec)
+            stop: stop time (unit: sec)
+            chunk_samples: number of input samples read per block
+            numtaps: FIR length (default: 20 * factor + 1)
+        Yields:
+            xp: time axis of the block (unit: sec)
+            yp: decimated data (n_channels, n_samples)
+        """
+        from scipy.signal import firwin, upfirdn
+
+        factor = int(factor)
+        if factor < 1 or chunk_samples <= 0:
+            raise Exception
+        if numtaps == None:
+            numtaps = 20 * factor + 1
+        numtaps = int(numtaps) | 1
+        taps = firwin(numtaps, 1.0 / factor) if factor > 1 else np.ones(1)
+        half = len(taps) // 2
+        # history kept before each output sample, padded so that upfirdn's output grid
+        # (multiples of factor) falls on the retained samples
+        lead = half + (-(len(taps) - 1)) % factor
+        if channels is None:
+            channels = list(self._channel_index)
+        self._check_channels(channels)
 
-        # dp_size = self.Data.Bytes[3]
-        # dp_type = self.Data.Type[3]
-        # fs = float(self.SamplingFreq)
-        #
-        # start = int(start * fs)
-        # stop = int(stop * fs)
-        #
-        # loc = self.BasicHeader['Bytes_in_Headers'] + self.Data.Bytes[:3].sum()
-        # f = self._fileobj
-        #
-        # ch_index = self.ChannelMap.index[self.ChannelMap['ID'] == ch_id].tolist()[0]
-        #
-        # f.seek(loc + ch_index * dp_size, 0)  # set first location
-        # if start == None:
-        #     start = 0
-        # else:
-        #     if start >= self.NumDataPoints:
-        #         raise Exception
-        #     f.seek(start * self.NumChannels * dp_size, 1)
-        #
-        # if stop == None:
-        #     stop = self.TotalDataPoints
-        # else:
-        #     if stop > self.TotalDataPoints:
-        #         raise Exception
-        # if down_sampling == None:
-        #     down_sampling = 1
-        # else:
-        #     if not isinstance(down_sampling, int):
-        #         raise Exception
-        #
-        # new_data_points = int((stop - start - self.TimeStamp) / down_sampling)
-        # data = []
-        #
-        # n_zpad = int((self.TimeStamp - start) / down_sampling)
-        # if n_zpad < 0:
-        #     n_zpad = 0
-        # if n_zpad != 0:
-        #     data.extend([0] * n_zpad)
-        #
-        # for dp in range(new_data_points):
-        #     data.append(struct.unpack(dp_type, f.read(dp_size))[0])
-        #     f.seek((self.NumChannels * down_sampling * dp_size) - dp_size, 1)
-        #
-        # xp = np.linspace(start / fs, stop / fs, new_data_points + n_zpad)
-        # yp = np.asarray(data)
-        #
-        # max_dv = self.ExtendedHeader[ch_id]['Max_Digital_Value']
-        # min_dv = self.ExtendedHeader[ch_id]['Min_Digital_Value']
-        # bias_dv = (max_dv + min_dv) / 2.0
-        #
-        # max_av = self.ExtendedHeader[ch_id]['Max_Analog_Value']
-        # min_av = self.ExtendedHeader[ch_id]['Min_Analog_Value']
-        # bias_av = (max_av + min_av) / 2.0
-        #
-        # centered_max_dv = max_dv - bias_dv
-        # centered_max_ac = max_av - bias_av
-        #
-        # yp = ((yp - bias_av) / (float(centered_max_dv) / float(centered_max_ac))) + bias_av
-        # return xp, yp
+        fs = float(self.SamplingFreq)
+        i0, i1 = self._get_sample_range(start, stop)
+        buf = None
+        buf_start = i0 - lead
+        n_next = i0
+        blocks = self._iter_windows(channels, i0, i1, chunk_samples)
+        while n_next < i1:
+            block = next(blocks, None)
+            if block is None:
+                # flush, extend the tail with the last sample
+                buf = np.concatenate([buf, np.repeat(buf[:, -1:], half, axis=1)], axis=1)
+            elif buf is None:
+                buf = np.concatenate([np.repeat(block[1][:, :1], lead, axis=1), block[1]], axis=1)
+            else:
+                buf = np.concatenate([buf, block[1]], axis=1)
+
+            last = buf_start + buf.shape[1] - 1 - half
+            if last < n_next:
+                continue
+            n_out = min((last - n_next) // factor, (i1 - 1 - n_next) // factor) + 1
+            loc = n_next - lead - buf_start
+            span = (n_out - 1) * factor + 1
+            yp = upfirdn(taps, buf[:, loc:loc + lead - half + span + len(taps) - 1], 1, factor, axis=1)
+            yp = yp[:, (lead - half + len(taps) - 1) // factor:][:, :n_out]
+            xp = (n_next + np.arange(n_out) * factor) / fs
+
+            n_next += n_out * factor
+            buf = buf[:, n_next - lead - buf_start:]
+            buf_start = n_next - lead
+            yield xp, yp
+
+    def get_epochs(self, times, pre, post, ch_ids=None, dtype=None, raw=False):
+        """ Event-aligned epochs gathered with a single fancy-indexing pass per segment
+        Parameters:
+            times: event times (unit: sec)
+            pre: window length before each event (unit: sec)
+            post: window length after each event (unit: sec)
+            ch_ids: list of channel IDs (default: all channels)
+            dtype: output dtype of the scaled data (e.g. np.float32)
+            raw: return unscaled digital values (see get_scale_from_channel)
+        Returns:
+            xp: time axis relative to the event (unit: sec)
+            epochs: data (n_events, n_channels, n_samples), samples outside the
+                    recorded segments are zero-padded like in get_data_from_channel
+        """
+        if ch_ids is None:
+            ch_ids = list(self._channel_index)
+        self._check_channels(ch_ids)
+        fs = float(self.SamplingFreq)
+        n_pre = int(round(pre * fs))
+        n_post = int(round(post * fs))
+        ch_indices = np.asarray([self._get_channel_index(ch_id) for ch_id in ch_ids], dtype=np.int64)
+
+        centers = np.round(np.asarray(times, dtype=np.float64).reshape(-1) * fs).astype(np.int64)
+        rows = centers[:, None] + np.arange(-n_pre, n_post, dtype=np.int64)[None, :]
+        gathered = np.zeros(rows.shape + (len(ch_indices),), dtype=self._data[0].dtype)
+
+        starts = self.Segments['Start']
+        ends = starts + self.Segments['Num_Data_Points']
+        seg = np.searchsorted(ends, rows, side='right')
+        for k in np.unique(seg[seg < len(starts)]).tolist():
+            mask = (seg == k) & (rows >= starts[k])
+            gathered[mask] = self._data[k][(rows[mask] - starts[k])[:, None], ch_indices[None, :]]
+
+        xp = np.arange(-n_pre, n_post) / fs
+        if raw:
+            return xp, np.ascontiguousarray(gathered.transpose(0, 2, 1))
+        epochs = np.empty((len(centers), len(ch_indices), n_pre + n_post),
+                          dtype=self._get_output_dtype(dtype, raw))
+        epochs[...] = gathered.transpose(0, 2, 1)
+        scales = np.asarray([self.get_scale_from_channel(ch_id) for ch_id in ch_ids],
+                            dtype=epochs.dtype).reshape(-1, 2)
+        epochs *= scales[None, :, :1]
+        epochs += scales[None, :, 1:]
+        return xp, epochs
 
     def get_unit_from_channel(self, ch_id):
         x_units = TIME_UNIT
@@ -239,8 +516,38 @@ class openNSx(BaseLoader):
         return x_units, y_units
 
     def close(self):
-        if self._fileobj != None:
-            self._fileobj.close()
+        self._data = None
+        self._close_map(self._fileobj)
 
     def __del__(self):
         self.close()
+
+
+def read_data_parallel(sources, ch_ids=None, start=None, stop=None, dtype=None, raw=False, workers=None):
+    """ Read the same window from several NSx files (e.g. the .ns2/.ns5/.ns6 of a session) in parallel
+    Parameters:
+        sources: list of file paths or openNSx objects
+        ch_ids: list of channel IDs (default: all channels of each file)
+        start: start time (unit: sec)
+        stop: stop time (unit: sec)
+        dtype: output dtype of the scaled data (e.g. np.float32)
+        raw: return unscaled digital values
+        workers: total number of threads (default: os.cpu_count())
+    Returns:
+        list of (xp, yp) in the order of sources
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    handles = [src if isinstance(src, openNSx) else openNSx(src) for src in sources]
+    if not len(handles):
+        return []
+    if workers == None:
+        workers = os.cpu_count() or 1
+    per_file = max(1, int(workers) // len(handles))
+
+    def read(nsx):
+        ids = list(nsx._channel_index) if ch_ids is None else ch_ids
+        return nsx.get_data_from_channels(ids, start, stop, dtype=dtype, raw=raw, workers=per_file)
+
+    with ThreadPoolExecutor(max_workers=min(int(workers), len(handles))) as pool:
+        return list(pool.map(read, handles))
@@ -0,0 +1,191 @@
+import os
+import threading
+import numpy as np
+from .nsx import openNSx
+from .nev import openNEV
+
+SESSION_STREAMS = ['nev', 'ns1', 'ns2', 'ns3', 'ns4', 'ns5', 'ns6']
+
+
+class Session(object):
+    """ The .nev and .ns1-.ns6 files of one recording, sharing a base name
+    files are discovered on construction but only opened (mmap and header parse) on first
+    access and then reused; every stream is placed on one timeline in seconds of the
+    NSP clock, using Time_Resolution_of_Time_Stamps (NSx) and TimeStamp_Resolution (NEV)
+    Parameters:
+        path: base path of the recording (e.g. 'datafile001') or any file of the set
+        workers: threads used to read several streams of a window concurrently
+    """
+    def __init__(self, path, workers=None):
+        base, ext = os.path.splitext(path)
+        if ext.lower().lstrip('.') not in SESSION_STREAMS:
+            base = path
+        self._base = base
+        self._workers = workers
+        self._streams = dict()
+        self._events = dict()
+        self._lock = threading.Lock()
+        self.Files = self._discover(base)
+        if not len(self.Files):
+            raise Exception(path)
+
+    @staticmethod
+    def _discover(base):
+        directory = os.path.dirname(base) or os.curdir
+        name = os.path.basename(base)
+        files = dict()
+        for filename in sorted(os.listdir(directory)):
+            stem, ext = os.path.splitext(filename)
+            key = ext.lower().lstrip('.')
+            if stem == name and key in SESSION_STREAMS:
+                files[key] = os.path.join(os.path.dirname(base), filename)
+        return {key: files[key] for key in SESSION_STREAMS if key in files.keys()}
+
+    @property
+    def Streams(self):
+        return list(self.Files.keys())
+
+    @property
+    def NEV(self):
+        return self['nev'] if 'nev' in self.Files.keys() else None
+
+    @property
+    def NSx(self):
+        return {key: self[key] for key in self.Streams if key != 'nev'}
+
+    def __getitem__(self, key):
+        """ Loader of the stream (e.g. 'nev', 'ns6'), opened on first access """
+        key = key.lower().lstrip('.')
+        if key not in self.Files.keys():
+            raise KeyError(key)
+        with self._lock:
+            if key not in self._streams.keys():
+                self._streams[key] = openNEV(self.Files[key]) if key == 'nev' else openNSx(self.Files[key])
+            return self._streams[key]
+
+    def __contains__(self, key):
+        return key.lower().lstrip('.') in self.Files.keys()
+
+    def get_resolution(self, key):
+        """ Clock ticks per second of the timestamps of the stream """
+        loader = self[key]
+        if key == 'nev':
+            return float(loader.BasicHeader['TimeStamp_Resolution'])
+        return float(loader.BasicHeader['Time_Resolution_of_Time_Stamps'])
+
+    def to_seconds(self, key, ticks):
+        """ Convert timestamps of the stream into seconds on the session timeline """
+        return np.asarray(ticks, dtype=np.float64) / self.get_resolution(key)
+
+    def to_ticks(self, key, seconds):
+        """ Convert session times (unit: sec) into timestamps of the stream """
+        return np.round(np.asarray(seconds, dtype=np.float64) * self.get_resolution(key)).astype(np.int64)
+
+    def get_extent(self, key=None):
+        """ First and last time covered by a stream, or by all streams (unit: sec) """
+        if key is None:
+            extents = [self.get_extent(k) for k in self.Streams]
+            return min(e[0] for e in extents), max(e[1] for e in extents)
+        loader = self[key]
+        if key == 'nev':
+            loader._parse_events_map()
+            tstamps = loader._packets['Timestamp']
+            if not len(tstamps):
+                return 0.0, 0.0
+            fs = self.get_resolution(key)
+            return int(tstamps.min()) / fs, (int(tstamps.max()) + 1) / fs
+        fs = float(loader.SamplingFreq)
+        return int(loader.Segments['Start'][0]) / fs, loader.TotalDataPoints / fs
+
+    def _read_nsx(self, key, t0, t1, ch_ids, dtype, raw):
+        nsx = self[key]
+        fs = float(nsx.SamplingFreq)
+        # [t0, t1) on the session timeline, only the overlapping byte ranges are read
+        i0 = 0 if t0 is None else int(np.ceil(round(t0 * fs, 6)))
+        i1 = nsx.TotalDataPoints if t1 is None else int(np.ceil(round(t1 * fs, 6)))
+        i0 = min(max(i0, 0), nsx.TotalDataPoints)
+        i1 = min(max(i1, i0), nsx.TotalDataPoints)
+        ids = list(nsx._channel_index) if ch_ids is None else ch_ids
+        return nsx._read_window(ids, i0, i1, dtype=dtype, raw=raw)
+
+    def _get_nev_events(self, name):
+        """ Decoded digital or comment events of the NEV stream, kept until it grows """
+        nev = self.NEV
+        num = len(nev._packets)
+        with self._lock:
+            cached = self._events.get(name)
+        if cached is None or cached[0] != num:
+            events = nev.get_digital_events() if name == 'Digital_Events' else nev.get_comment_events()
+            cached = (num, events)
+            with self._lock:
+                self._events[name] = cached
+        return cached[1]
+
+    def _read_nev(self, t0, t1, ch_ids, waveforms):
+        nev = self.NEV
+        nev._parse_events_map()
+        ids = list(nev._channel_index) if ch_ids is None else ch_ids
+        output = dict(Spikes=nev.get_spikes(ids, t0, t1, waveforms=waveforms))
+        fs = self.get_resolution('nev')
+        for name in ['Digital_Events', 'Comment_Events']:
+            events = self._get_nev_events(name)
+            if events is None:
+                continue
+            # events are in file (timestamp) order, the window is a contiguous slice
+            tstamps = events['Timestamp']
+            i0 = 0 if t0 is None else int(np.searchsorted(tstamps, np.ceil(t0 * fs), side='left'))
+            i1 = len(tstamps) if t1 is None else int(np.searchsorted(tstamps, np.ceil(t1 * fs), side='left'))
+            i1 = max(i1, i0)
+            output[name] = {k: v[i0:i1] for k, v in events.items()}
+        return output
+
+    def get_window(self, t0=None, t1=None, streams=None, channels=None, dtype=None, raw=False, waveforms=False):
+        """ Read the same window from several streams of the session
+        Parameters:
+            t0: window start, inclusive (unit: sec)
+            t1: window stop, exclusive (unit: sec)
+            streams: list of streams (e.g. ['nev', 'ns6'], default: all streams)
+            channels: list of channel IDs for every stream, or dict of {stream: list of channel IDs}
+            dtype: output dtype of the scaled continuous data (e.g. np.float32)
+            raw: return unscaled digital values of the continuous data
+            waveforms: also return spike waveforms
+        Returns:
+            dict of {stream: (xp, yp)} for NSx and
+            {'nev': dict(Spikes=get_spikes output, Digital_Events, Comment_Events)} for NEV
+        """
+        streams = self.Streams if streams is None else [s.lower().lstrip('.') for s in streams]
+        for key in streams:
+            if key not in self.Files.keys():
+                raise KeyError(key)
+
+        def read(key):
+            ch_ids = channels.get(key) if isinstance(channels, dict) else channels
+            if key == 'nev':
+                return self._read_nev(t0, t1, ch_ids, waveforms)
+            return self._read_nsx(key, t0, t1, ch_ids, dtype, raw)
+
+        if self._workers is not None and self._workers > 1 and len(streams) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            # open sequentially, reads of the separate mmaps then run concurrently
+            for key in streams:
+                self[key]
+            with ThreadPoolExecutor(max_workers=min(int(self._workers), len(streams))) as pool:
+                return dict(zip(streams, pool.map(read, streams)))
+        return {key: read(key) for key in streams}
+
+    def close(self):
+        with self._lock:
+            for loader in self._streams.values():
+                loader.close()
+            self._streams = dict()
+            self._events = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __repr__(self):
+        return 'Session({}, streams={})'.format(self._base, self.Streams)
@@ -0,0 +1,135 @@
+""" Synthetic NSx/NEV recordings written with the layouts of bmloader.lib
+for benchmarks and for reproducing issues without sharing real data
+"""
+import numpy as np
+from . import NSX_BASIC, NSX_EXTENDED, NSX_DATA, NEURALEV, NEUEVWAV, NEUEVLBL, \
+    NEV_EXTENDED_SIZE, NEV_PACKET_HEADER, NEV_PACKET_HEADER_SIZE, PACKETID_SIZE
+
+TIMESTAMP_RESOLUTION = 30000
+TIME_ORIGIN = (2020, 1, 3, 1, 12, 0, 0, 0)
+
+
+def _pack(layout, **values):
+    """ Pack a single header record, missing fields are zero (or empty strings) """
+    items = []
+    for field, count in zip(layout.Field, layout._counts):
+        value = values.get(field, b'' if count < 0 else 0)
+        if count < 0:
+            items.append(value.encode('latin-1') if isinstance(value, str) else value)
+        elif count == 1:
+            items.append(value)
+        else:
+            items.extend(value if isinstance(value, (tuple, list)) else [value] * count)
+    return layout.struct.pack(*items)
+
+
+def write_nsx(path, channels=32, duration=10.0, sampling_rate=30000, segments=1,
+              gap=1.0, seed=0, chunk_samples=65536):
+    """ Write a synthetic NSx file (File_Spec 2.3) of sine waves plus noise
+    Parameters:
+        path: output path (e.g. 'synthetic.ns6')
+        channels: number of channels
+        duration: total recorded duration (unit: sec), split evenly over the segments
+        sampling_rate: sampling rate (Hz), must divide TIMESTAMP_RESOLUTION
+        segments: number of data packets (pauses in the recording)
+        gap: pause between consecutive segments (unit: sec)
+        seed: random seed
+        chunk_samples: samples generated per write, bounds the memory used
+    Returns:
+        number of bytes written
+    """
+    if TIMESTAMP_RESOLUTION % sampling_rate:
+        raise Exception
+    period = TIMESTAMP_RESOLUTION // sampling_rate
+    rng = np.random.default_rng(seed)
+    header_size = NSX_BASIC.size + NSX_EXTENDED.size * channels
+    basic = _pack(NSX_BASIC, File_Type_ID='NEURALCD', File_Spec=(2, 3), Bytes_in_Headers=header_size,
+                  Label='{} S/s'.format(sampling_rate), Comment='synthetic', Period=period,
+                  Time_Resolution_of_Time_Stamps=TIMESTAMP_RESOLUTION, Time_Origin=TIME_ORIGIN,
+                  Channel_Count=channels)
+    extended = b''.join(_pack(NSX_EXTENDED, Type='CC', Electrode_ID=ch_id, Electrode_Label='chan{}'.format(ch_id),
+                              Physical_Connector=1, Connector_Pin=ch_id,
+                              Min_Digital_Value=-32764, Max_Digital_Value=32764,
+                              Min_Analog_Value=-8191, Max_Analog_Value=8191, Units='uV')
+                        for ch_id in range(1, channels + 1))
+    packet_header = NSX_DATA.struct.size - NSX_DATA.Bytes[-1]
+    freqs = rng.uniform(1, 200, size=channels)
+    bounds = np.linspace(0, int(duration * sampling_rate), segments + 1).astype(np.int64)
+    nbytes = 0
+    with open(path, 'wb') as f:
+        nbytes += f.write(basic + extended)
+        for k in range(segments):
+            start, stop = int(bounds[k]), int(bounds[k + 1])
+            timestamp = (start + int(k * gap * sampling_rate)) * period
+            nbytes += f.write(NSX_DATA.struct.pack(1, timestamp, stop - start, 0)[:packet_header])
+            for i0 in range(start, stop, chunk_samples):
+                i1 = min(i0 + chunk_samples, stop)
+                t = np.arange(i0, i1)[:, None] / float(sampling_rate)
+                data = 3000 * np.sin(2 * np.pi * freqs * t) + rng.normal(0, 500, size=(i1 - i0, channels))
+                nbytes += f.write(data.astype('<i2').tobytes())
+    return nbytes
+
+
+def write_nev(path, channels=32, duration=10.0, spike_rate=10.0, digital_rate=1.0, comments=0,
+              waveform_samples=48, seed=0):
+    """ Write a synthetic NEV file (File_Spec 2.3) of Poisson spike trains with waveforms,
+    digital events and comments, packets are written in timestamp order
+    Parameters:
+        path: output path (e.g. 'synthetic.nev')
+        channels: number of electrodes
+        duration: recorded duration (unit: sec)
+        spike_rate: mean firing rate per electrode (Hz)
+        digital_rate: mean rate of digital input events (Hz)
+        comments: number of comment events
+        waveform_samples: samples per spike waveform
+        seed: random seed
+    Returns:
+        number of bytes written
+    """
+    rng = np.random.default_rng(seed)
+    packet_size = NEV_PACKET_HEADER_SIZE + 2 + 2 * waveform_samples
+    header_size = NEURALEV.size + NEV_EXTENDED_SIZE * channels * 2
+    basic = _pack(NEURALEV, File_Type_ID='NEURALEV', File_Spec=(2, 3), Bytes_in_Headers=header_size,
+                  Bytes_in_DataPackets=packet_size, TimeStamp_Resolution=TIMESTAMP_RESOLUTION,
+                  Sample_Time_Resolution=TIMESTAMP_RESOLUTION, Time_Origin=TIME_ORIGIN,
+                  Creating_Application='bmloader.synthetic', Num_Extended_Headers=channels * 2)
+    extended = []
+    for ch_id in range(1, channels + 1):
+        extended.append('NEUEVWAV'.encode().ljust(PACKETID_SIZE, b'\x00') +
+                        _pack(NEUEVWAV, Electrode_ID=ch_id, Physical_Connector=1, Connector_Pin=ch_id,
+                              Digitization_Factor=250, Low_Threshold=-200, Num_Sorted_Units=2,
+                              Bytes_Per_Waveform=2, Spike_Width_Samples=waveform_samples))
+        extended.append('NEUEVLBL'.encode().ljust(PACKETID_SIZE, b'\x00') +
+                        _pack(NEUEVLBL, Electrode_ID=ch_id, Label='elec{}'.format(ch_id)))
+
+    n_ticks = int(duration * TIMESTAMP_RESOLUTION)
+    n_spikes = rng.poisson(spike_rate * duration, size=channels)
+    n_digital = rng.poisson(digital_rate * duration)
+    num = int(n_spikes.sum()) + n_digital + comments
+    packets = np.zeros(num, dtype=NEV_PACKET_HEADER + [('Payload', 'V{}'.format(packet_size - NEV_PACKET_HEADER_SIZE))])
+    packets['Timestamp'] = rng.integers(0, n_ticks, size=num)
+    packets['Packet_ID'][:n_spikes.sum()] = np.repeat(np.arange(1, channels + 1), n_spikes)
+    packets['Packet_ID'][n_spikes.sum():n_spikes.sum() + n_digital] = 0
+    packets['Packet_ID'][n_spikes.sum() + n_digital:] = 65535
+    packets = packets[np.argsort(packets['Timestamp'], kind='stable')]
+
+    raw = packets.view(np.uint8).reshape(num, packet_size)
+    spike = np.flatnonzero(packets['Packet_ID'] != 0)
+    spike = spike[packets['Packet_ID'][spike] != 65535]
+    raw[spike, NEV_PACKET_HEADER_SIZE] = rng.integers(0, 3, size=len(spike))
+    shape = np.exp(-0.5 * ((np.arange(waveform_samples) - waveform_samples / 4) / 2.0) ** 2)
+    waveforms = -800 * shape * rng.uniform(0.5, 1.5, size=(len(spike), 1)) + \
+        rng.normal(0, 30, size=(len(spike), waveform_samples))
+    raw[spike, NEV_PACKET_HEADER_SIZE + 2:] = waveforms.astype('<i2').view(np.uint8)
+
+    digital = np.flatnonzero(packets['Packet_ID'] == 0)
+    raw[digital, NEV_PACKET_HEADER_SIZE] = 1
+    raw[digital, NEV_PACKET_HEADER_SIZE + 2:NEV_PACKET_HEADER_SIZE + 4] = \
+        rng.integers(0, 65535, size=len(digital)).astype('<u2').view(np.uint8).reshape(-1, 2)
+
+    comment = np.frombuffer('synthetic'.encode('latin-1'), dtype=np.uint8)
+    for i in np.flatnonzero(packets['Packet_ID'] == 65535).tolist():
+        raw[i, NEV_PACKET_HEADER_SIZE + 6:NEV_PACKET_HEADER_SIZE + 6 + len(comment)] = comment
+
+    with open(path, 'wb') as f:
+        return f.write(basic + b''.join(extended) + packets.tobytes())
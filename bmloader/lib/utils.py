@@ -4,6 +4,23 @@ import errno
 import time
 import os
 import hashlib
+import tempfile
+import threading
+import shutil
+import json
+import sys
+from collections import OrderedDict
+import numpy as np
+from .metrics import stage, count
+
+FINGERPRINT_BYTES = 65536
+CACHE_MANIFEST = 'manifest.json'
+MEMORY_CACHE_BYTES = 256 * 1024 ** 2
+
+_cache_locks = dict()
+_cache_locks_guard = threading.Lock()
+_cache_config = dict(directory=None, max_bytes=None)
+_fingerprints = dict()
 
 def timeit(func):
     def wrapper(*args, **kwrags):
@@ -25,31 +42,407 @@ def ensure_directory(directory):
             raise e
 
 
-def disk_cache(basename, directory, method=False):
-    directory = os.path.expanduser(directory)
-    ensure_directory(directory)
+def _get_cache_lock(filepath):
+    with _cache_locks_guard:
+        if filepath not in _cache_locks.keys():
+            _cache_locks[filepath] = threading.Lock()
+        return _cache_locks[filepath]
+
+
+def _dump_node(obj, directory, files):
+    """ Manifest node of obj, arrays are written as .npy blobs next to the manifest """
+    if obj is None:
+        return dict(type='none')
+    if isinstance(obj, (bool, int, float, str)):
+        return dict(type='value', value=obj)
+    if isinstance(obj, (np.ndarray, np.generic)):
+        filename = '{}.npy'.format(len(files))
+        files.append(filename)
+        np.save(os.path.join(directory, filename), np.asarray(obj), allow_pickle=True)
+        return dict(type='ndarray' if isinstance(obj, np.ndarray) else 'scalar', file=filename)
+    if isinstance(obj, (tuple, list)):
+        return dict(type=type(obj).__name__, items=[_dump_node(v, directory, files) for v in obj])
+    if isinstance(obj, dict):
+        return dict(type='dict', items=[[_dump_node(k, directory, files), _dump_node(v, directory, files)]
+                                        for k, v in obj.items()])
+    # anything else falls back to a pickled blob
+    filename = '{}.pickle'.format(len(files))
+    files.append(filename)
+    with open(os.path.join(directory, filename), 'wb') as handle:
+        pickle.dump(obj, handle)
+    return dict(type='pickle', file=filename)
+
+
+def _load_node(node, directory, mmap_mode='r'):
+    kind = node['type']
+    if kind == 'none':
+        return None
+    if kind == 'value':
+        return node['value']
+    if kind in ('ndarray', 'scalar'):
+        filepath = os.path.join(directory, node['file'])
+        try:
+            array = np.load(filepath, mmap_mode=mmap_mode)
+        except ValueError:
+            # object arrays cannot be memory-mapped
+            array = np.load(filepath, allow_pickle=True)
+        if kind == 'scalar':
+            return array[()]
+        return array.view(np.ndarray)
+    if kind == 'tuple':
+        return tuple(_load_node(v, directory, mmap_mode) for v in node['items'])
+    if kind == 'list':
+        return [_load_node(v, directory, mmap_mode) for v in node['items']]
+    if kind == 'dict':
+        return {_load_node(k, directory, mmap_mode): _load_node(v, directory, mmap_mode)
+                for k, v in node['items']}
+    if kind == 'pickle':
+        with open(os.path.join(directory, node['file']), 'rb') as handle:
+            return pickle.load(handle)
+    raise Exception
+
+
+def _save_entry(obj, entry):
+    """ Write obj as .npy blobs plus a JSON manifest into a temporary directory and
+    rename it into place, so concurrent readers never see a partially written entry
+    """
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix='.tmp-')
+    try:
+        files = []
+        manifest = dict(root=_dump_node(obj, tmp_dir, files), files=files)
+        with open(os.path.join(tmp_dir, CACHE_MANIFEST), 'w') as handle:
+            json.dump(manifest, handle)
+        try:
+            os.replace(tmp_dir, entry)
+        except OSError:
+            # written by another process in the meantime
+            if not os.path.isfile(os.path.join(entry, CACHE_MANIFEST)):
+                raise
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def _load_entry(entry, mmap_mode='r'):
+    """ Load a cache entry, arrays are memory-mapped read-only from their .npy blobs
+    (or read into memory when mmap_mode is None)
+    """
+    with open(os.path.join(entry, CACHE_MANIFEST), 'r') as handle:
+        manifest = json.load(handle)
+    return _load_node(manifest['root'], entry, mmap_mode)
+
+
+def _entry_size(entry):
+    size = 0
+    for filename in os.listdir(entry):
+        size += os.stat(os.path.join(entry, filename)).st_size
+    return size
+
+
+def set_cache_dir(directory=None):
+    """ Set the global cache root used by every disk_cache entry
+
+    Parameters:
+        directory: path of the cache root, None to fall back to the
+                   BMLOADER_CACHE_DIR environment variable or the per-class default
+    """
+    _cache_config['directory'] = directory
+
+
+def get_cache_dir(default=None):
+    """ Return the cache root currently in effect, resolved at call time """
+    directory = _cache_config['directory'] or os.environ.get('BMLOADER_CACHE_DIR') or default
+    if directory is None:
+        directory = os.path.join(os.curdir, '_bmcache_')
+    return os.path.expanduser(directory)
+
+
+def set_cache_size(max_bytes=None):
+    """ Set the size cap of the cache root in bytes
+
+    Parameters:
+        max_bytes: the least recently used entries are evicted once the cache
+                   grows beyond this size, None for no limit
+    """
+    _cache_config['max_bytes'] = max_bytes
+
+
+def get_cache_size():
+    max_bytes = _cache_config['max_bytes']
+    if max_bytes is None and os.environ.get('BMLOADER_CACHE_SIZE'):
+        max_bytes = int(os.environ['BMLOADER_CACHE_SIZE'])
+    return max_bytes
+
+
+class _MemoryCache(object):
+    """ In-process LRU of decoded results with a byte budget, shared by every loader instance """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items.keys():
+                return None
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def fits(self, size):
+        max_bytes = self.max_bytes
+        return max_bytes is None or 0 < size <= max_bytes
+
+    def put(self, key, value):
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._items.keys():
+                self.nbytes -= self._items.pop(key)[1]
+            if not self.fits(size):
+                return
+            self._items[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._items.keys():
+                self.nbytes -= self._items.pop(key)[1]
+
+    def _evict(self):
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and len(self._items):
+            _, (_, size) = self._items.popitem(last=False)
+            self.nbytes -= size
+            count('cache.memory_evictions')
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _freeze(obj):
+    """ Mark every array of a result read-only, so the copy held by the cache cannot be modified """
+    if isinstance(obj, np.ndarray):
+        obj.setflags(write=False)
+    elif isinstance(obj, (tuple, list)):
+        for v in obj:
+            _freeze(v)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _freeze(v)
+    return obj
+
+
+def _share(obj):
+    """ Result for one caller: containers are rebuilt and arrays are read-only views
+    of the cached (frozen) arrays
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.view()
+    if isinstance(obj, tuple):
+        return tuple(_share(v) for v in obj)
+    if isinstance(obj, list):
+        return [_share(v) for v in obj]
+    if isinstance(obj, dict):
+        return {k: _share(v) for k, v in obj.items()}
+    return obj
+
+
+def _nbytes(obj):
+    """ Approximate memory footprint of a cached result """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum(_nbytes(v) for v in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(_nbytes(k) + _nbytes(v) for k, v in obj.items())
+    return sys.getsizeof(obj)
+
+
+_memory_cache = _MemoryCache(int(os.environ.get('BMLOADER_MEMORY_CACHE_SIZE', MEMORY_CACHE_BYTES)))
+
+
+def set_memory_cache_size(max_bytes=MEMORY_CACHE_BYTES):
+    """ Set the byte budget of the in-process cache tier
+
+    Parameters:
+        max_bytes: least recently used results are dropped beyond this size,
+                   0 disables the memory tier, None for no limit
+    """
+    _memory_cache.resize(max_bytes)
+
+
+def clear_memory_cache():
+    """ Drop every result held by the in-process cache tier """
+    _memory_cache.clear()
+
+
+def clear_cache(directory=None):
+    """ Remove every cache entry under the given (or current) cache root,
+    and every result held by the in-process tier
+    """
+    _memory_cache.clear()
+    directory = directory or get_cache_dir()
+    for entry in _list_cache_entries(directory):
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+def file_fingerprint(path):
+    """ Content fingerprint of a recording: file size, mtime and a hash of the header bytes
+
+    Parameters:
+        path: path of the source file
+    Returns:
+        hex digest which changes whenever the file is replaced or re-exported
+    """
+    stat = os.stat(path)
+    token = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _cache_locks_guard:
+        if token in _fingerprints.keys():
+            return _fingerprints[token]
+    with open(path, 'rb') as f:
+        digest = _fingerprint(stat.st_size, stat.st_mtime_ns, f.read(FINGERPRINT_BYTES))
+    with _cache_locks_guard:
+        _fingerprints[token] = digest
+    return digest
+
+
+def mapped_fingerprint(fileobj, stat):
+    """ Content fingerprint of a mapped file, taken from the bytes that were actually mapped
+    so results computed from this map are never stored under the key of a later version
+
+    Parameters:
+        fileobj: mmap of the file
+        stat: os.fstat of the descriptor that was mapped
+    Returns:
+        hex digest (see file_fingerprint)
+    """
+    return _fingerprint(len(fileobj), stat.st_mtime_ns, fileobj[:FINGERPRINT_BYTES])
+
+
+def _fingerprint(size, mtime_ns, header):
+    sha1 = hashlib.sha1('{}:{}'.format(size, mtime_ns).encode('utf-8'))
+    sha1.update(header)
+    return sha1.hexdigest()
+
+
+def _source_fingerprint(source):
+    # loaders carry the fingerprint of their map, taken in load()
+    fingerprint = getattr(source, '_fingerprint', None)
+    if fingerprint is not None:
+        return fingerprint
+    path = getattr(source, '_path', source)
+    if isinstance(path, str) and os.path.isfile(path):
+        return file_fingerprint(path)
+    return None
+
+
+def _cache_key(basename, args, kwargs, method):
+    fingerprint = _source_fingerprint(args[0]) if args else None
+    if method:
+        args = args[1:]
+    key = repr((basename, fingerprint, tuple(args), tuple(sorted(kwargs.items()))))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _list_cache_entries(directory):
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, f) for f in os.listdir(directory)
+            if os.path.isfile(os.path.join(directory, f, CACHE_MANIFEST))]
+
+
+def _evict_cache(directory, max_bytes):
+    """ Remove least recently used entries until the cache fits in max_bytes,
+    entries are touched on every hit so mtime orders them by last use
+    """
+    entries = []
+    for entry in _list_cache_entries(directory):
+        try:
+            mtime = os.stat(os.path.join(entry, CACHE_MANIFEST)).st_mtime_ns
+            entries.append((mtime, _entry_size(entry), entry))
+        except OSError:
+            continue
+    total = sum(e[1] for e in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        # arrays already mapped by a reader stay valid after the unlink
+        shutil.rmtree(entry, ignore_errors=True)
+        count('cache.disk_evictions')
+        total -= size
+
+
+def _get_memory_entry(name):
+    stored = _memory_cache.get(name)
+    if stored is None:
+        return None
+    count('cache.memory_hits')
+    return _share(stored)
+
+
+def disk_cache(basename, directory=None, method=False):
+    """ Cache the output of a loader method on disk
 
+    Entries are keyed on the content fingerprint of the source file, taken when
+    the loader mapped it (see mapped_fingerprint), together with the remaining
+    arguments, so stale entries are never served after a file is replaced. The cache root is resolved at
+    call time (set_cache_dir or BMLOADER_CACHE_DIR, then the given directory).
+    Each entry is a directory of .npy blobs with a JSON manifest. Results are also
+    held in memory by an in-process LRU shared by all instances (see
+    set_memory_cache_size), checked before the disk and independent of the disk size
+    cap; entries larger than its budget are served memory-mapped from disk instead.
+    Every call hands out its own containers, but arrays are read-only views of the
+    cached ones: copy them (np.array) before modifying.
+    """
     def wrapper(func):
         @functools.wraps(func)
         def wrapped(*args, **kwargs):
-            key = (args[0]._path, *tuple(args), *tuple(kwargs.items()))
-            if method and key:
-                key = key[1:]
-            hash_input = []
-            for k in key:
-                if isinstance(k, str):
-                    k = int(hashlib.sha1(k.encode('utf-8')).hexdigest(), 16) % (10 ** 8)
-                hash_input.append(k)
-
-            filename = '{}-{}.pickle'.format(basename, hash(tuple(hash_input)))
-            filepath = os.path.join(directory, filename)
-            if os.path.isfile(filepath):
-                with open(filepath, 'rb') as handle:
-                    return pickle.load(handle)
-            result = func(*args, **kwargs)
-            with open(filepath, 'wb') as handle:
-                pickle.dump(result, handle)
-            return result
+            name = '{}-{}'.format(basename, _cache_key(basename, args, kwargs, method))
+            result = _get_memory_entry(name)
+            if result is not None:
+                return result
+            cache_dir = get_cache_dir(directory)
+            ensure_directory(cache_dir)
+            entry = os.path.join(cache_dir, name)
+            # one computation per entry when called from several threads
+            with _get_cache_lock(entry):
+                result = _get_memory_entry(name)
+                if result is not None:
+                    return result
+                if os.path.isfile(os.path.join(entry, CACHE_MANIFEST)):
+                    try:
+                        with stage('cache.read'):
+                            # read into memory when the entry fits the memory tier, else mapped
+                            resident = _memory_cache.fits(_entry_size(entry))
+                            stored = _freeze(_load_entry(entry, mmap_mode=None if resident else 'r'))
+                        os.utime(os.path.join(entry, CACHE_MANIFEST))
+                        count('cache.disk_hits')
+                        if resident:
+                            _memory_cache.put(name, stored)
+                        return _share(stored)
+                    except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+                        # evicted concurrently or unreadable, recompute below
+                        pass
+                count('cache.misses')
+                result = _freeze(func(*args, **kwargs))
+                with stage('cache.write'):
+                    _save_entry(result, entry)
+                _memory_cache.put(name, result)
+            max_bytes = get_cache_size()
+            if max_bytes is not None:
+                _evict_cache(cache_dir, max_bytes)
+            return _share(result)
 
         return wrapped
 